@@ -0,0 +1,26 @@
+"""Start an IPython kernel with modules imported in advance.
+
+Modules are given by HEXE_PRELOAD as comma-separated names. They are imported
+before the kernel starts, so that importing them in a cell costs nothing.
+Arguments are passed to the kernel as with ipykernel_launcher.
+"""
+
+import importlib
+import os
+import sys
+
+# ipykernel selects the inline backend through this variable, but matplotlib
+# reads it only once on import.
+os.environ.setdefault("MPLBACKEND", "module://matplotlib_inline.backend_inline")
+
+for name in os.environ.get("HEXE_PRELOAD", "").split(","):
+    if name:
+        try:
+            importlib.import_module(name)
+        except Exception as err:
+            print(f"Failed to preload {name}: {err}", file=sys.stderr)
+
+if __name__ == "__main__":
+    from ipykernel import kernelapp
+
+    kernelapp.launch_new_instance()
@@ -1,8 +1,26 @@
+import asyncio
+import base64
 import hashlib
+import hmac
+import json
 import secrets
 import sqlite3
+import threading
 import time
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
+from typing import Any, TypeVar
+
+T = TypeVar("T")
+
+# Parameters of scrypt for each hash version.
+# Add a new version to tune the parameters. Passwords are rehashed on login.
+HASH_PARAMS = {
+    1: {"n": 16 * 1024, "r": 8, "p": 1},
+}
+
+CURRENT_HASH_VERSION = max(HASH_PARAMS.keys())
 
 
 @dataclass
@@ -11,7 +29,11 @@ class User:
     name: str
 
 
-def hash_password(password: str, salt: str) -> str:
+class Overloaded(Exception):
+    """Too many password hashing requests are waiting."""
+
+
+def hash_password(password: str, salt: str, version: int = CURRENT_HASH_VERSION) -> str:
     """
     >>> a = hash_password("123456", "salt")
     >>> a
@@ -28,10 +50,200 @@ def hash_password(password: str, salt: str) -> str:
     """
 
     return hashlib.scrypt(
-        password.encode("utf-8"), salt=salt.encode("utf-8"), n=16 * 1024, r=8, p=1
+        password.encode("utf-8"), salt=salt.encode("utf-8"), **HASH_PARAMS[version]
     ).hex()
 
 
+class PasswordHasher:
+    """Hash passwords in a thread pool not to block the event loop.
+
+    `hashlib.scrypt` releases the GIL, so threads run it in parallel.
+
+    >>> hasher = PasswordHasher(max_workers=1, max_queue=0)
+    >>> asyncio.run(hasher.hash("123456", "salt")) == hash_password("123456", "salt")
+    True
+
+    >>> async def burst() -> list[str | BaseException]:
+    ...     return await asyncio.gather(
+    ...         hasher.hash("123456", "salt"),
+    ...         hasher.hash("123456", "salt"),
+    ...         return_exceptions=True,
+    ...     )
+    >>> [type(x).__name__ for x in asyncio.run(burst())]
+    ['str', 'Overloaded']
+    """
+
+    def __init__(self, max_workers: int = 2, max_queue: int = 16) -> None:
+        """Initialize the hasher.
+
+        :param max_workers: Number of threads to hash passwords.
+        :param max_queue: Number of requests that can wait for a thread.
+        """
+
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.__pending = 0
+        self.__executor = ThreadPoolExecutor(
+            max_workers, thread_name_prefix="hexe-hasher"
+        )
+
+    async def run(self, function: Callable[..., T], *args: Any) -> T:
+        """Run a function hashing passwords in the thread pool.
+
+        :raises Overloaded: If too many requests are waiting.
+        """
+
+        if self.__pending >= self.max_workers + self.max_queue:
+            raise Overloaded("Too many password hashing requests")
+
+        self.__pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self.__executor, function, *args
+            )
+        finally:
+            self.__pending -= 1
+
+    async def hash(
+        self, password: str, salt: str, version: int = CURRENT_HASH_VERSION
+    ) -> str:
+        """Hash a password in the thread pool.
+
+        :raises Overloaded: If too many requests are waiting.
+        """
+
+        return await self.run(hash_password, password, salt, version)
+
+    def shutdown(self) -> None:
+        self.__executor.shutdown(wait=False, cancel_futures=True)
+
+
+@dataclass(frozen=True)
+class SignedToken:
+    user: User
+    expires: int
+    jti: str
+
+
+class TokenSigner:
+    """Sign and verify stateless session tokens with HMAC-SHA256.
+
+    The first key signs new tokens, and all keys verify tokens. To rotate
+    keys, put a new key first, and remove the old key after its tokens have
+    expired.
+
+    >>> alice = User(id="alc", name="alice")
+    >>> signer = TokenSigner({"k1": b"secret1"})
+    >>> token = signer.sign(alice, expires=int(time.time()) + 60)
+    >>> signer.verify(token).user
+    User(id='alc', name='alice')
+
+    >>> signer.verify(token[:-2])
+    Traceback (most recent call last):
+        ...
+    ValueError: Invalid token
+
+    >>> signer.verify(signer.sign(alice, expires=0))
+    Traceback (most recent call last):
+        ...
+    ValueError: Invalid token
+
+    >>> rotated = TokenSigner({"k2": b"secret2", "k1": b"secret1"})
+    >>> rotated.verify(token).user
+    User(id='alc', name='alice')
+    >>> rotated.sign(alice, expires=0).startswith("k2.")
+    True
+
+    >>> TokenSigner({"k2": b"secret2"}).verify(token)
+    Traceback (most recent call last):
+        ...
+    ValueError: Invalid token
+    """
+
+    def __init__(self, keys: dict[str, bytes]) -> None:
+        """Initialize the signer.
+
+        :param keys: Map of key ID to secret key. The first one is used to sign.
+        """
+
+        if len(keys) == 0:
+            raise ValueError("At least one key is required")
+        if any("." in kid for kid in keys):
+            raise ValueError("Key ID must not contain '.'")
+
+        self.keys = keys
+        self.current = next(iter(keys))
+
+    @staticmethod
+    def parse_keys(s: str) -> dict[str, bytes]:
+        """Parse keys in `kid1:secret1,kid2:secret2` format.
+
+        >>> TokenSigner.parse_keys("new:abc,old:def")
+        {'new': b'abc', 'old': b'def'}
+        """
+
+        keys = {}
+        for pair in s.split(","):
+            kid, _, secret = pair.strip().partition(":")
+            if kid and secret:
+                keys[kid] = secret.encode("utf-8")
+        return keys
+
+    def __signature(self, kid: str, payload: str) -> str:
+        mac = hmac.digest(self.keys[kid], f"{kid}.{payload}".encode("ascii"), "sha256")
+        return base64.urlsafe_b64encode(mac).decode("ascii").rstrip("=")
+
+    def sign(self, user: User, expires: int) -> str:
+        payload = json.dumps(
+            {
+                "sub": user.id,
+                "name": user.name,
+                "exp": expires,
+                "jti": secrets.token_urlsafe(12),
+            },
+            separators=(",", ":"),
+        )
+        encoded = base64.urlsafe_b64encode(payload.encode("utf-8"))
+        encoded_payload = encoded.decode("ascii").rstrip("=")
+
+        return ".".join(
+            [
+                self.current,
+                encoded_payload,
+                self.__signature(self.current, encoded_payload),
+            ]
+        )
+
+    def verify(self, token: str) -> SignedToken:
+        """Verify the token without accessing database.
+
+        :raises ValueError: If the token is broken, forged, or expired.
+        """
+
+        try:
+            kid, payload, signature = token.split(".")
+            if kid not in self.keys or not hmac.compare_digest(
+                signature, self.__signature(kid, payload)
+            ):
+                raise ValueError("Invalid signature")
+
+            claims = json.loads(
+                base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4))
+            )
+            result = SignedToken(
+                user=User(id=str(claims["sub"]), name=str(claims["name"])),
+                expires=int(claims["exp"]),
+                jti=str(claims["jti"]),
+            )
+        except Exception:
+            raise ValueError("Invalid token")
+
+        if result.expires <= time.time():
+            raise ValueError("Invalid token")
+
+        return result
+
+
 class Auth:
     """
     >>> auth = Auth(":memory:")
@@ -54,6 +266,9 @@ class Auth:
     >>> auth.get_user(token)
     User(id='alc', name='alice')
 
+    >>> auth.get_user(token) is auth.get_user(token)
+    True
+
     >>> auth.get_user("123456")
     Traceback (most recent call last):
         ...
@@ -70,22 +285,77 @@ class Auth:
     Traceback (most recent call last):
         ...
     ValueError: Invalid token
-    """
 
-    def __init__(self, path: str) -> None:
-        self.db = sqlite3.connect(path)
+    >>> token3 = asyncio.run(auth.alogin("alc", "123456"))
+    >>> auth.get_user(token3)
+    User(id='alc', name='alice')
+
+    >>> asyncio.run(auth.alogin("alc", "hello"))
+    Traceback (most recent call last):
+        ...
+    ValueError: Invalid ID or password
+
+    With `signer`, tokens are verified without the sessions table.
 
-        with self.db as conn:
+    >>> auth.signer = TokenSigner({"k1": b"secret"})
+    >>> signed = auth.login("alc", "123456")
+    >>> auth.get_user(signed)
+    User(id='alc', name='alice')
+
+    >>> auth.get_user(token3)
+    User(id='alc', name='alice')
+
+    >>> auth.logout(signed)
+    >>> auth.get_user(signed)
+    Traceback (most recent call last):
+        ...
+    ValueError: Invalid token
+    """
+
+    def __init__(
+        self,
+        path: str,
+        cache_ttl: float = 60,
+        hasher: PasswordHasher | None = None,
+        signer: TokenSigner | None = None,
+    ) -> None:
+        """Initialize the database.
+
+        :param path: Path to the database. `:memory:` for in-memory database.
+        :param cache_ttl: Seconds to cache a session without checking the database.
+        :param hasher: Hasher for `alogin` and `aregister`.
+        :param signer: Signer to issue stateless tokens instead of DB sessions.
+            DB sessions issued before are still accepted.
+        """
+
+        # `alogin` and `aregister` access the database in the thread pool.
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.__lock = threading.Lock()
+        self.cache_ttl = cache_ttl
+        self.hasher = hasher if hasher is not None else PasswordHasher()
+        self.signer = signer
+        self.__cache: dict[str, tuple[User, float]] = {}
+        self.__revoked: dict[str, int] = {}
+
+        with self.__lock, self.db as conn:
             conn.execute(
                 """
                 CREATE TABLE IF NOT EXISTS users (
                     id TEXT PRIMARY KEY,
                     name TEXT NOT NULL,
                     password TEXT NOT NULL,
-                    salt TEXT NOT NULL
+                    salt TEXT NOT NULL,
+                    hash_version INTEGER NOT NULL DEFAULT 1
                 )
                 """
             )
+            columns = [x[1] for x in conn.execute("PRAGMA table_info(users)")]
+            if "hash_version" not in columns:
+                conn.execute(
+                    """
+                    ALTER TABLE users ADD COLUMN hash_version INTEGER NOT NULL DEFAULT 1
+                    """
+                )
             conn.execute(
                 """
                 CREATE TABLE IF NOT EXISTS sessions (
@@ -96,86 +366,193 @@ class Auth:
                 )
                 """
             )
+            conn.execute(
+                """
+                CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires)
+                """
+            )
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS revoked_tokens (
+                    jti TEXT PRIMARY KEY NOT NULL,
+                    expires INTEGER NOT NULL
+                )
+                """
+            )
+
+        self.cleanup()
 
     def cleanup(self) -> None:
-        with self.db as conn:
+        """Delete expired sessions, and reload revoked signed tokens.
+
+        This is not called by other methods. Call it periodically.
+        """
+
+        now = time.time()
+
+        with self.__lock, self.db as conn:
             conn.execute(
                 """
                 DELETE FROM sessions WHERE expires < ?
                 """,
-                (int(time.time()),),
+                (int(now),),
             )
+            conn.execute(
+                """
+                DELETE FROM revoked_tokens WHERE expires < ?
+                """,
+                (int(now),),
+            )
+            self.__revoked = dict(
+                conn.execute("SELECT jti, expires FROM revoked_tokens").fetchall()
+            )
+
+        for token, (_, expires) in list(self.__cache.items()):
+            if expires <= now:
+                del self.__cache[token]
 
     def register(self, name: str, id: str, password: str) -> None:
         salt = secrets.token_urlsafe()
-        password = hash_password(password, salt)
+        self.__insert_user(name, id, hash_password(password, salt), salt)
+
+    async def aregister(self, name: str, id: str, password: str) -> None:
+        """Same as `register`, but run it in the thread pool of `hasher`.
+
+        :raises Overloaded: If too many hashing requests are waiting.
+        """
 
-        with self.db as conn:
+        await self.hasher.run(self.register, name, id, password)
+
+    def login(
+        self, user_id: str, password: str, expires_in: int = 365 * 24 * 60 * 60
+    ) -> str:
+        name, in_db, salt, version = self.__credential(user_id)
+
+        if in_db != hash_password(password, salt, version):
+            raise ValueError("Invalid ID or password")
+
+        if version != CURRENT_HASH_VERSION:
+            salt = secrets.token_urlsafe()
+            self.__update_password(user_id, hash_password(password, salt), salt)
+
+        return self.__create_session(User(id=user_id, name=name), expires_in)
+
+    async def alogin(
+        self, user_id: str, password: str, expires_in: int = 365 * 24 * 60 * 60
+    ) -> str:
+        """Same as `login`, but run it in the thread pool of `hasher`.
+
+        :raises Overloaded: If too many hashing requests are waiting.
+        """
+
+        return await self.hasher.run(self.login, user_id, password, expires_in)
+
+    def __insert_user(self, name: str, id: str, password: str, salt: str) -> None:
+        with self.__lock, self.db as conn:
             conn.execute(
                 """
-                INSERT INTO users (id, name, password, salt)
-                VALUES (?, ?, ?, ?)
+                INSERT INTO users (id, name, password, salt, hash_version)
+                VALUES (?, ?, ?, ?, ?)
                 """,
-                (id, name, password, salt),
+                (id, name, password, salt, CURRENT_HASH_VERSION),
             )
 
-    def login(
-        self, user_id: str, password: str, expires_in: int = 365 * 24 * 60 * 60
-    ) -> str:
-        with self.db as conn:
+    def __update_password(self, id: str, password: str, salt: str) -> None:
+        with self.__lock, self.db as conn:
+            conn.execute(
+                """
+                UPDATE users SET password = ?, salt = ?, hash_version = ?
+                WHERE id = ?
+                """,
+                (password, salt, CURRENT_HASH_VERSION, id),
+            )
+
+    def __credential(self, user_id: str) -> tuple[str, str, str, int]:
+        with self.__lock, self.db as conn:
             cursor = conn.execute(
                 """
-                SELECT password, salt FROM users WHERE id = ?
+                SELECT name, password, salt, hash_version FROM users WHERE id = ?
                 """,
                 (user_id,),
             )
             row = cursor.fetchone()
 
-            if row is None:
-                raise ValueError("Invalid ID or password")
+        if row is None:
+            raise ValueError("Invalid ID or password")
+
+        return row[0], row[1], row[2], int(row[3])
 
-            in_db, salt = row
-            param = hash_password(password, salt)
+    def __create_session(self, user: User, expires_in: int) -> str:
+        expires = int(time.time()) + expires_in
 
-            if in_db != param:
-                raise ValueError("Invalid ID or password")
+        if self.signer is not None:
+            return self.signer.sign(user, expires)
 
-            token = secrets.token_urlsafe(32)
-            expires = int(time.time()) + expires_in
+        token = secrets.token_urlsafe(32)
 
+        with self.__lock, self.db as conn:
             conn.execute(
                 """
                 INSERT INTO sessions (user_id, token, expires)
                 VALUES (?, ?, ?)
                 """,
-                (user_id, token, expires),
+                (user.id, token, expires),
             )
 
-        self.cleanup()
-
         return token
 
     def get_user(self, token: str) -> User:
-        with self.db as conn:
+        if self.signer is not None and "." in token:
+            signed = self.signer.verify(token)
+            if signed.jti in self.__revoked:
+                raise ValueError("Invalid token")
+            return signed.user
+
+        now = time.time()
+
+        if token in self.__cache:
+            user, expires = self.__cache[token]
+            if now < expires:
+                return user
+            del self.__cache[token]
+
+        with self.__lock, self.db as conn:
             cursor = conn.execute(
                 """
-                SELECT id, name
+                SELECT id, name, expires
                 FROM sessions, users
                 WHERE token = ? AND expires > ? AND sessions.user_id = users.id
                 """,
-                (token, int(time.time())),
+                (token, int(now)),
             )
             row = cursor.fetchone()
 
         if row is None:
             raise ValueError("Invalid token")
 
-        self.cleanup()
+        user = User(id=row[0], name=row[1])
+        self.__cache[token] = (user, min(now + self.cache_ttl, row[2]))
 
-        return User(id=row[0], name=row[1])
+        return user
 
     def logout(self, token: str) -> None:
-        with self.db as conn:
+        if self.signer is not None and "." in token:
+            try:
+                signed = self.signer.verify(token)
+            except ValueError:
+                return
+
+            self.__revoked[signed.jti] = signed.expires
+            with self.__lock, self.db as conn:
+                conn.execute(
+                    """
+                    REPLACE INTO revoked_tokens (jti, expires) VALUES (?, ?)
+                    """,
+                    (signed.jti, signed.expires),
+                )
+            return
+
+        with self.__lock, self.db as conn:
             conn.execute(
                 """
                 DELETE FROM sessions WHERE token = ?
@@ -183,4 +560,4 @@ class Auth:
                 (token,),
             )
 
-        self.cleanup()
+        self.__cache.pop(token, None)
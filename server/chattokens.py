@@ -0,0 +1,223 @@
+from collections.abc import Callable
+from dataclasses import dataclass
+from typing import Any
+
+from openaitypes import Message
+from tokenizer import Tokenizer
+
+FunctionDefinition = dict[str, Any]
+
+
+@dataclass(frozen=True)
+class ChatModel:
+    """Token accounting parameters of a chat model."""
+
+    name: str
+    context_length: int
+    tokens_per_message: int = 3
+    tokens_per_name: int = 1
+
+
+MODELS = {
+    x.name: x
+    for x in [
+        ChatModel("gpt-3.5-turbo", 4096),
+        ChatModel("gpt-3.5-turbo-0301", 4096, tokens_per_message=4, tokens_per_name=-1),
+        ChatModel("gpt-3.5-turbo-16k", 16385),
+        ChatModel("gpt-3.5-turbo-1106", 16385),
+        ChatModel("gpt-4", 8192),
+        ChatModel("gpt-4-32k", 32768),
+        ChatModel("gpt-4-1106-preview", 128000),
+    ]
+}
+
+
+def get_model(name: str) -> ChatModel:
+    """Get the chat model by name. Dated snapshots match the base model.
+
+    >>> get_model("gpt-4-0613").context_length
+    8192
+    >>> get_model("gpt-3.5-turbo-16k-0613").context_length
+    16385
+    >>> get_model("unknown")
+    Traceback (most recent call last):
+        ...
+    ValueError: Unknown chat model: unknown
+    """
+
+    if name in MODELS:
+        return MODELS[name]
+
+    candidates = [x for x in MODELS if name.startswith(f"{x}-")]
+    if len(candidates) == 0:
+        raise ValueError(f"Unknown chat model: {name}")
+
+    return MODELS[max(candidates, key=len)]
+
+
+def format_functions(functions: list[FunctionDefinition]) -> str:
+    """Format function definitions in the way the model reads them.
+
+    >>> print(format_functions([{
+    ...     "name": "search",
+    ...     "description": "Search notes.",
+    ...     "parameters": {
+    ...         "type": "object",
+    ...         "required": ["query"],
+    ...         "properties": {
+    ...             "query": {"type": "string"},
+    ...             "term": {"type": "string", "enum": ["a day", "forever"]},
+    ...         },
+    ...     },
+    ... }]))
+    namespace functions {
+    <BLANKLINE>
+    // Search notes.
+    type search = (_: {
+    query: string,
+    term?: "a day" | "forever",
+    }) => any;
+    <BLANKLINE>
+    } // namespace functions
+    """
+
+    lines = ["namespace functions {", ""]
+
+    for function in functions:
+        if "description" in function:
+            lines.append(f"// {function['description']}")
+
+        parameters = function.get("parameters", {})
+        if len(parameters.get("properties", {})) > 0:
+            lines.append(f"type {function['name']} = (_: {{")
+            lines.append(_format_properties(parameters, 0))
+            lines.append("}) => any;")
+        else:
+            lines.append(f"type {function['name']} = () => any;")
+
+        lines.append("")
+
+    lines.append("} // namespace functions")
+
+    return "\n".join(lines)
+
+
+def _format_properties(schema: dict[str, Any], indent: int) -> str:
+    lines = []
+
+    for name, prop in schema.get("properties", {}).items():
+        if "description" in prop and indent < 2:
+            lines.append(f"// {prop['description']}")
+
+        optional = "" if name in schema.get("required", []) else "?"
+        lines.append(f"{name}{optional}: {_format_type(prop, indent)},")
+
+    return "\n".join(" " * indent + line for line in lines)
+
+
+def _format_type(schema: dict[str, Any], indent: int) -> str:
+    match schema.get("type"):
+        case "string":
+            if "enum" in schema:
+                return " | ".join(f'"{x}"' for x in schema["enum"])
+            return "string"
+        case "number" | "integer" as type_:
+            if "enum" in schema:
+                return " | ".join(str(x) for x in schema["enum"])
+            return type_
+        case "array":
+            if "items" in schema:
+                return f"{_format_type(schema['items'], indent)}[]"
+            return "any[]"
+        case "boolean" | "null" as type_:
+            return type_
+        case "object":
+            return "\n".join(["{", _format_properties(schema, indent + 2), "}"])
+        case _:
+            return "any"
+
+
+class ChatTokenCounter:
+    """Counter of prompt tokens of chat completion requests.
+
+    This counts the framing of messages and function definitions as well as
+    their contents, so that the result matches `usage.prompt_tokens`.
+
+    >>> counter = ChatTokenCounter("gpt-3.5-turbo", count=lambda x: len(x.split()))
+    >>> counter.message({"role": "user", "content": "Hello there"})
+    6
+    >>> counter.request([{"role": "user", "content": "Hello there"}])
+    9
+    """
+
+    def __init__(self, model: str, count: Callable[[str], int] | None = None) -> None:
+        """Initialize the counter.
+
+        :param model: Name of the chat model.
+        :param count: Function to count tokens of a text. `Tokenizer.count`
+            by default.
+        """
+
+        self.model = get_model(model)
+        self.__count = count if count is not None else Tokenizer().count
+
+    def message(self, message: Message, padded: bool = False) -> int:
+        """Count tokens of a message in a request.
+
+        :param padded: Whether the content is padded with a newline, as done
+            for the first system message when functions are given.
+        """
+
+        n_tokens = self.model.tokens_per_message + self.__count(message["role"])
+
+        content = message.get("content")
+        if content is not None:
+            n_tokens += self.__count(f"{content}\n" if padded else content)
+
+        name = message.get("name")
+        if isinstance(name, str):
+            n_tokens += self.model.tokens_per_name + self.__count(name)
+
+        if message["role"] == "function":
+            n_tokens -= 2
+
+        function_call = message.get("function_call")
+        if isinstance(function_call, dict):
+            n_tokens += 3
+            n_tokens += self.__count(function_call["name"])
+            n_tokens += self.__count(function_call["arguments"])
+
+        return n_tokens
+
+    def functions(self, functions: list[FunctionDefinition]) -> int:
+        """Count tokens of function definitions in a request."""
+
+        if len(functions) == 0:
+            return 0
+
+        return self.__count(format_functions(functions)) + 9
+
+    def request(
+        self,
+        messages: list[Message],
+        functions: list[FunctionDefinition] | None = None,
+    ) -> int:
+        """Count prompt tokens of a request, including the priming of the reply."""
+
+        functions = functions if functions is not None else []
+        n_tokens = 3
+        padded = False
+
+        for message in messages:
+            if message["role"] == "system" and len(functions) > 0 and not padded:
+                n_tokens += self.message(message, padded=True)
+                padded = True
+            else:
+                n_tokens += self.message(message)
+
+        if len(functions) > 0:
+            n_tokens += self.functions(functions)
+            if any(x["role"] == "system" for x in messages):
+                n_tokens -= 4
+
+        return n_tokens
@@ -1,220 +1,869 @@
+import asyncio
 import json
+import logging
+import os
+import time
 import uuid
-from collections.abc import AsyncIterator
+from collections.abc import AsyncIterator, Awaitable, Callable
+from dataclasses import dataclass
 from datetime import datetime
+from typing import Any
 
 from jupyter_client import AsyncKernelClient, AsyncKernelManager
 from jupyter_client.kernelspec import KernelSpec, KernelSpecManager
 
 import event
+from output import OutputBuffer, output_path, prune_outputs
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class ResourceLimits:
+    """Limits of resources of a kernel container. None for no limit."""
+
+    # Number of CPUs, like 1.5.
+    cpus: float | None = None
+    # Memory in the format of docker, like `512m` or `2g`. Swap is not allowed.
+    memory: str | None = None
+    # Number of processes and threads.
+    pids: int | None = None
+
+    def docker_options(self) -> list[str]:
+        """Get options of `docker run` to apply the limits.
+
+        >>> ResourceLimits(cpus=1, memory="1g", pids=256).docker_options()
+        ['--cpus=1', '--memory=1g', '--memory-swap=1g', '--pids-limit=256']
+        """
+
+        options = []
+        if self.cpus is not None:
+            options.append(f"--cpus={self.cpus:g}")
+        if self.memory is not None:
+            options += [f"--memory={self.memory}", f"--memory-swap={self.memory}"]
+        if self.pids is not None:
+            options.append(f"--pids-limit={self.pids}")
+
+        return options
 
 
 class HexeKernelSpecManager(KernelSpecManager):
-    def __init__(self, user_id: str) -> None:
-        self.__user_id = user_id
+    """Kernel specs to run kernels of languages in docker containers.
+
+    Containers are limited by `limits`. Kernels of languages in `preload`
+    start with the given modules imported, so that the first import of them
+    in a cell costs nothing. The image of the language must have
+    /opt/hexe/preload.py.
+
+    >>> specs = HexeKernelSpecManager(
+    ...     {"python": ["numpy", "pandas"]}, ResourceLimits(pids=256)
+    ... )
+    >>> argv = specs.get_kernel_spec("hexe-python").argv
+    >>> argv[-7:-4]
+    ['-e', 'HEXE_PRELOAD=numpy,pandas', 'hexe-python-kernel']
+    >>> argv[-4:]
+    ['/usr/bin/python3', '/opt/hexe/preload.py', '-f', 'connection_file']
+    >>> specs.get_kernel_spec("hexe-bash").argv[-2:]
+    ['--pids-limit=256', 'hexe-bash-kernel']
+    """
+
+    def __init__(
+        self,
+        preload: dict[str, list[str]] | None = None,
+        limits: ResourceLimits | None = None,
+    ) -> None:
+        """Initialize the manager.
+
+        :param preload: Modules to import in advance per language.
+        :param limits: Limits of resources of each kernel.
+        """
+
+        self.preload = preload if preload is not None else {}
+        self.limits = limits if limits is not None else ResourceLimits()
 
     def get_kernel_spec(self, kernel_name: str) -> KernelSpec:
         kernel_name = kernel_name.replace("hexe-", "")
 
-        return KernelSpec(
-            display_name=kernel_name,
-            language=kernel_name,
-            argv=[
-                "docker",
-                "run",
-                "--network=host",
-                "--rm",
-                "-v",
-                "{connection_file}:/connection_file",
+        argv = [
+            "docker",
+            "run",
+            "--network=host",
+            "--rm",
+            "-v",
+            "{connection_file}:/connection_file",
+            *self.limits.docker_options(),
+        ]
+
+        modules = self.preload.get(kernel_name, [])
+        if len(modules) > 0:
+            argv += [
+                "-e",
+                f"HEXE_PRELOAD={','.join(modules)}",
                 f"hexe-{kernel_name}-kernel",
-            ],
-        )
+                "/usr/bin/python3",
+                "/opt/hexe/preload.py",
+                "-f",
+                "connection_file",
+            ]
+        else:
+            argv.append(f"hexe-{kernel_name}-kernel")
+
+        return KernelSpec(display_name=kernel_name, language=kernel_name, argv=argv)
+
+    @staticmethod
+    def parse_preload(value: str) -> dict[str, list[str]]:
+        """Parse modules to preload per language, like `python=numpy,pandas`.
+
+        >>> HexeKernelSpecManager.parse_preload("python=numpy, matplotlib.pyplot")
+        {'python': ['numpy', 'matplotlib.pyplot']}
+        >>> HexeKernelSpecManager.parse_preload("python")
+        Traceback (most recent call last):
+            ...
+        ValueError: Invalid preload: python
+        """
+
+        preload: dict[str, list[str]] = {}
+        for entry in value.split(";"):
+            if entry.strip() == "":
+                continue
+            if "=" not in entry:
+                raise ValueError(f"Invalid preload: {entry}")
+
+            language, modules = entry.split("=", 1)
+            preload[language.strip()] = [
+                x.strip() for x in modules.split(",") if x.strip()
+            ]
+
+        return preload
+
+
+# Queue of iopub messages of an execution, or an error of reading them.
+Messages = asyncio.Queue[dict[str, Any] | Exception]
+
+
+class Kernel:
+    """A started kernel and its client.
+
+    Messages on iopub are read by a single task, and routed by the ID of the
+    request they reply to, so that an execution never takes messages of
+    another one.
+
+    >>> class FakeClient:
+    ...     def __init__(self) -> None:
+    ...         self.messages: asyncio.Queue = asyncio.Queue()
+    ...     def execute(self, code: str) -> str:
+    ...         self.messages.put_nowait({"parent_header": {"msg_id": code}})
+    ...         return code
+    ...     async def get_iopub_msg(self) -> dict:
+    ...         return await self.messages.get()
+    >>> async def main() -> None:
+    ...     kernel = Kernel(None, FakeClient())
+    ...     a, a_messages = kernel.execute("a")
+    ...     b, b_messages = kernel.execute("b")
+    ...     print(await b_messages.get(), await a_messages.get())
+    ...     kernel.release(a)
+    ...     kernel.release(b)
+    ...     await kernel.stop_reading()
+    >>> asyncio.run(main())
+    {'parent_header': {'msg_id': 'b'}} {'parent_header': {'msg_id': 'a'}}
+
+    If reading fails, executions get the error instead of messages, and the
+    kernel is no longer alive.
+
+    >>> class BrokenClient(FakeClient):
+    ...     async def get_iopub_msg(self) -> dict:
+    ...         raise ConnectionError("closed")
+    >>> async def broken() -> None:
+    ...     kernel = Kernel(None, BrokenClient())
+    ...     _, messages = kernel.execute("a")
+    ...     print(repr(await messages.get()), await kernel.is_alive())
+    >>> asyncio.run(broken())
+    ConnectionError('closed') False
+    """
+
+    def __init__(self, manager: AsyncKernelManager, client: AsyncKernelClient) -> None:
+        self.manager = manager
+        self.client = client
+
+        self.__routes: dict[str, Messages] = {}
+        self.__reader: asyncio.Task | None = None
+        self.__failure: Exception | None = None
+
+    def execute(self, code: str) -> tuple[str, Messages]:
+        """Request to execute code.
+
+        Returns the ID of the request and a queue of iopub messages for it,
+        which is to be released after the execution. The queue gets an
+        exception instead if reading messages fails.
+        """
+
+        if self.__reader is None:
+            self.__reader = asyncio.create_task(self.__read())
+
+        messages: Messages = asyncio.Queue()
+        if self.__failure is not None:
+            msg_id = str(uuid.uuid4())
+            messages.put_nowait(self.__failure)
+        else:
+            msg_id = self.client.execute(code)
+        self.__routes[msg_id] = messages
+
+        return msg_id, messages
+
+    def release(self, msg_id: str) -> None:
+        """Stop routing messages for the request."""
+
+        self.__routes.pop(msg_id, None)
+
+    async def __read(self) -> None:
+        while True:
+            try:
+                msg = await self.client.get_iopub_msg()
+            except Exception as err:
+                logger.exception("Failed to read iopub messages")
+
+                # Executions would wait for messages until they time out.
+                self.__failure = err
+                for queue in self.__routes.values():
+                    queue.put_nowait(err)
+                return
+
+            messages = self.__routes.get(msg.get("parent_header", {}).get("msg_id"))
+            if messages is not None:
+                messages.put_nowait(msg)
+
+    async def stop_reading(self) -> None:
+        if self.__reader is not None:
+            self.__reader.cancel()
+            await asyncio.gather(self.__reader, return_exceptions=True)
+            self.__reader = None
+
+    async def is_alive(self) -> bool:
+        if self.__failure is not None:
+            return False
+        return await self.manager.is_alive()
+
+    async def exit_code(self) -> int | None:
+        """Get the exit code of the kernel, or None if it's running."""
+
+        if self.manager.provisioner is None:
+            return None
+        return await self.manager.provisioner.poll()
+
+    async def shutdown(self) -> None:
+        await self.stop_reading()
+        self.client.stop_channels()
+        await self.manager.shutdown_kernel()
+
+
+async def start_kernel(
+    language: str,
+    kernel_spec_manager: HexeKernelSpecManager | None = None,
+    timeout: float = 60,
+) -> Kernel:
+    """Start a kernel of the language, and wait until it gets ready.
+
+    :param kernel_spec_manager: Specs of kernels. Kernels without preloading
+        by default.
+    :param timeout: Seconds to wait for the kernel to get ready.
+    """
+
+    km = AsyncKernelManager(
+        kernel_name=f"hexe-{language}",
+        kernel_spec_manager=(
+            kernel_spec_manager
+            if kernel_spec_manager is not None
+            else HexeKernelSpecManager()
+        ),
+    )
+    await km.start_kernel()
+
+    kc = km.client()
+    kc.start_channels()
+
+    try:
+        await kc.wait_for_ready(timeout=timeout)
+    except BaseException:
+        kc.stop_channels()
+        await km.shutdown_kernel(now=True)
+        raise
+
+    return Kernel(km, kc)
+
+
+class KernelPool:
+    """Pool of started kernels per language.
+
+    At least `min_size` kernels are kept started for each language, and
+    kernels are started again in the background as they are taken. Whenever
+    a kernel is requested while none is left, one more kernel is kept for
+    the language, up to `max_size`. After `shrink_interval` seconds without
+    such a miss, one less kernel is kept again, down to `min_size`, and an
+    idle kernel above the number is shut down. Taken kernels are not
+    returned to the pool, since they have states of the user.
+
+    >>> class FakeKernel:
+    ...     async def is_alive(self) -> bool:
+    ...         return True
+    ...     async def shutdown(self) -> None:
+    ...         print("shut down")
+    >>> async def start(language: str) -> FakeKernel:
+    ...     await asyncio.sleep(0)
+    ...     return FakeKernel()
+    >>> async def main() -> None:
+    ...     pool = KernelPool(
+    ...         ["python"], min_size=1, max_size=2, shrink_interval=0.05, start=start
+    ...     )
+    ...     pool.start()
+    ...     await asyncio.sleep(0.01)
+    ...     print(pool.stats()["python"])
+    ...     await pool.acquire("python")
+    ...     await pool.acquire("python")
+    ...     await asyncio.sleep(0.01)
+    ...     print(pool.stats()["python"])
+    ...     await asyncio.sleep(0.1)
+    ...     print(pool.stats()["python"])
+    ...     await pool.shutdown()
+    >>> asyncio.run(main())
+    {'idle': 1, 'starting': 0, 'target': 1, 'hits': 0, 'misses': 0}
+    {'idle': 2, 'starting': 0, 'target': 2, 'hits': 1, 'misses': 1}
+    shut down
+    {'idle': 1, 'starting': 0, 'target': 1, 'hits': 1, 'misses': 1}
+    shut down
+    """
+
+    def __init__(
+        self,
+        languages: list[str],
+        min_size: int = 1,
+        max_size: int = 4,
+        retry_interval: float = 10,
+        shrink_interval: float = 600,
+        start: Callable[[str], Awaitable[Kernel]] = start_kernel,
+    ) -> None:
+        """Initialize the pool.
+
+        :param languages: Languages to keep kernels of.
+        :param min_size: Number of kernels to keep started for each language.
+        :param max_size: Maximum number of kernels to keep started for each
+            language.
+        :param retry_interval: Seconds to wait after failing to start a kernel.
+        :param shrink_interval: Seconds without a miss to keep one less kernel
+            for a language.
+        :param start: Function to start a kernel of a language.
+        """
+
+        if not 0 <= min_size <= max_size:
+            raise ValueError("The sizes must satisfy 0 <= min_size <= max_size.")
+
+        self.min_size = min_size
+        self.max_size = max_size
+        self.retry_interval = retry_interval
+        self.shrink_interval = shrink_interval
+
+        self.__start = start
+        self.__idle: dict[str, list[Kernel]] = {x: [] for x in languages}
+        self.__starting = {x: 0 for x in languages}
+        self.__target = {x: min_size for x in languages}
+        self.__hits = {x: 0 for x in languages}
+        self.__misses = {x: 0 for x in languages}
+        self.__resized_at = {x: time.monotonic() for x in languages}
+        self.__tasks: set[asyncio.Task] = set()
+        self.__failed_at: float | None = None
+        self.__closed = False
+
+    def start(self) -> None:
+        """Start kernels in the background. Needs a running event loop."""
+
+        self.__refill()
+
+        task = asyncio.create_task(self.__shrink())
+        self.__tasks.add(task)
+        task.add_done_callback(self.__tasks.discard)
+
+    async def __shrink(self) -> None:
+        while True:
+            await asyncio.sleep(self.shrink_interval / 2)
+
+            for language, target in self.__target.items():
+                if target <= self.min_size:
+                    continue
+                if (
+                    time.monotonic() - self.__resized_at[language]
+                    < self.shrink_interval
+                ):
+                    continue
+
+                self.__target[language] = target - 1
+                self.__resized_at[language] = time.monotonic()
+
+                idle = self.__idle[language]
+                if len(idle) > 0 and len(idle) + self.__starting[language] > target - 1:
+                    try:
+                        await idle.pop().shutdown()
+                    except Exception:
+                        logger.exception("Failed to shut down a kernel of %s", language)
+
+    def __refill(self) -> None:
+        if self.__closed:
+            return
+
+        for language, target in self.__target.items():
+            while len(self.__idle[language]) + self.__starting[language] < target:
+                self.__starting[language] += 1
+                task = asyncio.create_task(self.__start_one(language))
+                self.__tasks.add(task)
+                task.add_done_callback(self.__tasks.discard)
+
+    async def __start_one(self, language: str) -> None:
+        if self.__failed_at is not None:
+            await asyncio.sleep(
+                max(0, self.__failed_at + self.retry_interval - time.monotonic())
+            )
+
+        try:
+            kernel = await self.__start(language)
+        except Exception:
+            logger.exception("Failed to start a kernel of %s", language)
+            self.__failed_at = time.monotonic()
+            self.__starting[language] -= 1
+            await asyncio.sleep(self.retry_interval)
+            self.__refill()
+            return
+
+        self.__failed_at = None
+        self.__starting[language] -= 1
+        if self.__closed:
+            await kernel.shutdown()
+        else:
+            self.__idle[language].append(kernel)
+
+    async def acquire(self, language: str) -> Kernel:
+        """Take a started kernel of the language, or start one if none is left.
+
+        Kernels that died while waiting in the pool are discarded.
+        """
+
+        if language not in self.__idle:
+            return await self.__start(language)
+
+        try:
+            while len(self.__idle[language]) > 0:
+                kernel = self.__idle[language].pop(0)
+                if await kernel.is_alive():
+                    self.__hits[language] += 1
+                    return kernel
+
+                logger.warning("Discarded a dead kernel of %s", language)
+                await kernel.shutdown()
+
+            self.__misses[language] += 1
+            self.__target[language] = min(self.__target[language] + 1, self.max_size)
+            self.__resized_at[language] = time.monotonic()
+            return await self.__start(language)
+        finally:
+            self.__refill()
+
+    def stats(self) -> dict[str, dict[str, int]]:
+        """Get numbers of kernels and hits of the pool per language."""
+
+        return {
+            x: {
+                "idle": len(self.__idle[x]),
+                "starting": self.__starting[x],
+                "target": self.__target[x],
+                "hits": self.__hits[x],
+                "misses": self.__misses[x],
+            }
+            for x in self.__idle
+        }
+
+    async def shutdown(self) -> None:
+        """Shut down kernels in the pool. Taken kernels are not shut down."""
+
+        self.__closed = True
+
+        for task in list(self.__tasks):
+            task.cancel()
+        await asyncio.gather(*self.__tasks, return_exceptions=True)
+
+        kernels = [x for xs in self.__idle.values() for x in xs]
+        for xs in self.__idle.values():
+            xs.clear()
+        await asyncio.gather(*[x.shutdown() for x in kernels], return_exceptions=True)
+
+
+@dataclass(frozen=True)
+class RunnerOptions:
+    """Options of executions of code."""
+
+    # Seconds to run code until interrupting it.
+    timeout: float = 60
+    # Seconds to wait for interrupted code to stop until replacing the kernel.
+    interrupt_timeout: float = 5
+    # Bytes to keep of each of the head and the tail of stream output.
+    max_output_bytes: int = 65536
+    # Directory to write stream output longer than `max_output_bytes` to.
+    # None not to write.
+    output_dir: str | None = None
+    # Number of files of outputs to keep per user.
+    max_output_files: int = 100
+    # Seconds to coalesce stream output into a delta event.
+    delta_interval: float = 0.1
 
 
 class CodeRunner:
-    km: AsyncKernelManager
-    kc: AsyncKernelClient | None = None
+    kernel: Kernel | None = None
+
+    def __init__(
+        self,
+        user_id: str,
+        language: str,
+        pool: KernelPool | None = None,
+        options: RunnerOptions | None = None,
+        start: Callable[[str], Awaitable[Kernel]] | None = None,
+    ) -> None:
+        """Initialize the runner.
+
+        :param pool: Pool to take a kernel from. None to start a kernel.
+        :param options: Options of executions.
+        :param start: Function to start a kernel of a language without the
+            pool. `start_kernel` by default.
+        """
 
-    def __init__(self, user_id: str, language: str) -> None:
         self.user_id = user_id
         self.language = language
+        self.pool = pool
+        self.__start = start if start is not None else start_kernel
+        self.options = options if options is not None else RunnerOptions()
 
-        self.km = AsyncKernelManager(
-            kernel_name=f"hexe-{language}",
-            kernel_spec_manager=HexeKernelSpecManager(user_id),
-        )
+        # Executions hold this to run one at a time in order, so that a
+        # timeout or a restart of the kernel affects only its own execution.
+        self.__lock = asyncio.Lock()
 
-    async def _start(self) -> AsyncKernelClient:
-        if self.kc is not None:
-            return self.kc
-        else:
-            await self.km.start_kernel()
-
-            self.kc = self.km.client()
-            self.kc.start_channels()
+    async def _start(self) -> Kernel:
+        if self.kernel is None:
+            if self.pool is not None:
+                self.kernel = await self.pool.acquire(self.language)
+            else:
+                self.kernel = await self.__start(self.language)
 
-            return self.kc
+        return self.kernel
 
     async def shutdown(self) -> None:
-        if self.kc is not None:
-            self.kc.stop_channels()
-
-        await self.km.shutdown_kernel()
+        if self.kernel is not None:
+            await self.kernel.shutdown()
+            self.kernel = None
+
+    async def __stalled(self) -> tuple[str, str] | None:
+        """Get the code and message of an error if the kernel has died.
+
+        The dead kernel is discarded, and the next execution takes a new one.
+        """
+
+        assert self.kernel is not None
+
+        if await self.kernel.is_alive():
+            return None
+
+        exit_code = await self.kernel.exit_code()
+        await self.shutdown()
+
+        # docker exits with 128 + SIGKILL when the kernel is killed by OOM.
+        if exit_code == 137:
+            return (
+                "out_of_memory",
+                "The kernel ran out of memory and was restarted."
+                " Variables and imports were lost.",
+            )
+        return (
+            "kernel_died",
+            f"The kernel died with exit code {exit_code} and was restarted."
+            " Variables and imports were lost.",
+        )
 
     async def execute(
         self, source: uuid.UUID, code: str
     ) -> AsyncIterator[event.FunctionOutput | event.Error]:
-        if self.kc is None:
-            self.kc = await self._start()
-
+        """Run code, and yield its outputs.
+
+        Executions run one at a time in the order they are requested. Code
+        running longer than `timeout` is interrupted, and the kernel is
+        replaced if the code doesn't stop in `interrupt_timeout`. A timeout or
+        death of the kernel is reported as an Error with `code`.
+
+        Stream output is sent in deltas every `delta_interval` until it
+        exceeds `max_output_bytes`. The final output keeps its head and tail,
+        and the whole output is written to a file in `output_dir`.
+        """
+
+        async with self.__lock:
+            kernel = await self._start()
+            msg_id, messages = kernel.execute(code)
+            try:
+                async for ev in self.__execute(source, messages):
+                    yield ev
+            finally:
+                kernel.release(msg_id)
+
+    async def __execute(
+        self, source: uuid.UUID, messages: Messages
+    ) -> AsyncIterator[event.FunctionOutput | event.Error]:
         stream_id = uuid.uuid4()
         stime = datetime.now()
 
-        msg_id = self.kc.execute(code)
-
-        content = ""
+        path = (
+            output_path(self.options.output_dir, self.user_id, str(stream_id))
+            if self.options.output_dir is not None
+            else None
+        )
+        output = OutputBuffer(self.options.max_output_bytes, path=path)
+        try:
+            async for ev in self.__receive(source, messages, stream_id, stime, output):
+                yield ev
+        finally:
+            output.close()
+            if output.spilled and path is not None:
+                prune_outputs(os.path.dirname(path), self.options.max_output_files)
+
+    async def __receive(
+        self,
+        source: uuid.UUID,
+        messages: Messages,
+        stream_id: uuid.UUID,
+        stime: datetime,
+        output: OutputBuffer,
+    ) -> AsyncIterator[event.FunctionOutput | event.Error]:
         result: event.FunctionOutput | None = None
+        deadline = time.monotonic() + self.options.timeout
+        interrupted = False
+        error: tuple[str, str] | None = None
 
-        while True:
-            print("waiting...")
-            msg = await self.kc.get_iopub_msg()
-            print("got message", msg)
+        # Stream output not sent in a delta yet.
+        pending: list[str] = []
+        flushed_at = time.monotonic()
 
-            if msg.get("parent_header", {}).get("msg_id") == msg_id:
-                if msg["msg_type"] == "error":
-                    yield event.Error(
-                        id=uuid.uuid4(),
+        while True:
+            timeout = min(1, max(0, deadline - time.monotonic()))
+            if len(pending) > 0:
+                timeout = min(
+                    timeout,
+                    max(0, flushed_at + self.options.delta_interval - time.monotonic()),
+                )
+
+            msg: dict[str, Any] | None = None
+            try:
+                item = await asyncio.wait_for(messages.get(), timeout=timeout)
+            except asyncio.TimeoutError:
+                if len(pending) > 0:
+                    yield event.FunctionOutput(
+                        id=stream_id,
+                        name="run_code",
+                        content="".join(pending),
                         source=source,
-                        content=msg["content"]["evalue"],
+                        delta=True,
+                        created_at=stime,
                     )
+                    pending.clear()
+                    flushed_at = time.monotonic()
+                    if time.monotonic() < deadline:
+                        continue
+
+                error = await self.__stalled()
+
+                if error is None and time.monotonic() >= deadline:
+                    if not interrupted:
+                        assert self.kernel is not None
+                        await self.kernel.manager.interrupt_kernel()
+                        interrupted = True
+                        deadline = time.monotonic() + self.options.interrupt_timeout
+                        continue
 
-                if msg["msg_type"] == "stream":
-                    content += msg["content"]["text"]
+                    await self.shutdown()
+                    error = (
+                        "timeout",
+                        f"Execution timed out after {self.options.timeout:g}"
+                        " seconds, and the kernel was restarted. Variables and"
+                        " imports were lost.",
+                    )
+
+                if error is None:
+                    continue
+            else:
+                if isinstance(item, Exception):
+                    await self.shutdown()
+                    error = (
+                        "kernel_died",
+                        f"Lost connection to the kernel ({item}), and the kernel"
+                        " was restarted. Variables and imports were lost.",
+                    )
+                else:
+                    msg = item
+
+            if msg is None:
+                assert error is not None
+                if output.size > 0:
                     yield event.FunctionOutput(
                         id=stream_id,
                         name="run_code",
-                        content=msg["content"]["text"],
+                        content=output.getvalue(),
                         source=source,
-                        delta=True,
                         created_at=stime,
                     )
+                yield event.Error(source=source, content=error[1], code=error[0])
+                return
 
-                if msg["msg_type"] == "display_data":
-                    if "text/html" in msg["content"]["data"]:
-                        yield event.FunctionOutput(
-                            id=uuid.uuid4(),
-                            name="run_code",
-                            content=msg["content"]["data"]["text/html"],
-                            source=source,
-                            created_at=datetime.now(),
-                        )
-                        continue
+            if msg["msg_type"] == "error" and not interrupted:
+                yield event.Error(
+                    id=uuid.uuid4(),
+                    source=source,
+                    content=msg["content"]["evalue"],
+                )
 
-                    if "application/json" in msg["content"]["data"]:
-                        yield event.FunctionOutput(
-                            id=uuid.uuid4(),
-                            name="run_code",
-                            content="```json\n"
-                            + msg["content"]["data"]["application/json"]
-                            + "\n```",
-                            source=source,
-                            created_at=datetime.now(),
-                        )
-                        continue
+            if msg["msg_type"] == "stream":
+                output.write(msg["content"]["text"])
 
-                    videotype = [
-                        x
-                        for x in msg["content"]["data"].keys()
-                        if x.startswith("video/")
-                    ]
-                    if len(videotype) > 0:
-                        usetype = videotype[0]
-                        if "video/mp4" in videotype:
-                            usetype = "video/mp4"
-
-                        alt = (
-                            msg["content"]["data"]
-                            .get("text/plain", "")
-                            .replace('"', "&quot;")
-                        )
-
-                        yield event.FunctionOutput(
-                            id=uuid.uuid4(),
-                            name="run_code",
-                            content=(
-                                "<video"
-                                f" src=\"data:{usetype};base64,{msg['content']['data'][usetype]}\""
-                                f' controls="controls" alt="{alt}" />'
-                            ),
-                            source=source,
-                            created_at=datetime.now(),
-                        )
-                        continue
+                # Deltas stop once the output gets long, and the final output
+                # with the middle omitted replaces them.
+                if not output.truncated:
+                    pending.append(msg["content"]["text"])
 
-                    imgtype = [
-                        x
-                        for x in msg["content"]["data"].keys()
-                        if x.startswith("image/")
-                    ]
-                    if len(imgtype) > 0:
-                        usetype = imgtype[0]
-                        if "image/svg+xml" in imgtype:
-                            usetype = "image/svg+xml"
-                        if "image/png" in imgtype:
-                            usetype = "image/png"
-                        if "image/jpeg" in imgtype:
-                            usetype = "image/jpeg"
-
-                        alt = (
-                            msg["content"]["data"]
-                            .get("text/plain", "")
-                            .replace('"', "&quot;")
-                        )
-
-                        yield event.FunctionOutput(
-                            id=uuid.uuid4(),
-                            name="run_code",
-                            content=(
-                                "<img"
-                                f" src=\"data:{usetype};base64,{msg['content']['data'][usetype]}\""
-                                f' alt="{alt}" />'
-                            ),
-                            source=source,
-                            created_at=datetime.now(),
-                        )
-                        continue
+                if (
+                    len(pending) > 0
+                    and time.monotonic() - flushed_at >= self.options.delta_interval
+                ):
+                    yield event.FunctionOutput(
+                        id=stream_id,
+                        name="run_code",
+                        content="".join(pending),
+                        source=source,
+                        delta=True,
+                        created_at=stime,
+                    )
+                    pending.clear()
+                    flushed_at = time.monotonic()
 
+            if msg["msg_type"] == "display_data":
+                if "text/html" in msg["content"]["data"]:
+                    yield event.FunctionOutput(
+                        id=uuid.uuid4(),
+                        name="run_code",
+                        content=msg["content"]["data"]["text/html"],
+                        source=source,
+                        created_at=datetime.now(),
+                    )
+                    continue
+
+                if "application/json" in msg["content"]["data"]:
                     yield event.FunctionOutput(
                         id=uuid.uuid4(),
                         name="run_code",
                         content="```json\n"
-                        + json.dumps(msg["content"]["data"], sort_keys=True, indent=4)
+                        + msg["content"]["data"]["application/json"]
                         + "\n```",
                         source=source,
                         created_at=datetime.now(),
                     )
+                    continue
+
+                videotype = [
+                    x for x in msg["content"]["data"].keys() if x.startswith("video/")
+                ]
+                if len(videotype) > 0:
+                    usetype = videotype[0]
+                    if "video/mp4" in videotype:
+                        usetype = "video/mp4"
+
+                    alt = (
+                        msg["content"]["data"]
+                        .get("text/plain", "")
+                        .replace('"', "&quot;")
+                    )
 
-                if msg["msg_type"] == "execute_result":
-                    result = event.FunctionOutput(
+                    yield event.FunctionOutput(
                         id=uuid.uuid4(),
                         name="run_code",
-                        content=msg["content"]["data"]["text/plain"],
+                        content=(
+                            "<video"
+                            f" src=\"data:{usetype};base64,{msg['content']['data'][usetype]}\""
+                            f' controls="controls" alt="{alt}" />'
+                        ),
                         source=source,
                         created_at=datetime.now(),
                     )
+                    continue
+
+                imgtype = [
+                    x for x in msg["content"]["data"].keys() if x.startswith("image/")
+                ]
+                if len(imgtype) > 0:
+                    usetype = imgtype[0]
+                    if "image/svg+xml" in imgtype:
+                        usetype = "image/svg+xml"
+                    if "image/png" in imgtype:
+                        usetype = "image/png"
+                    if "image/jpeg" in imgtype:
+                        usetype = "image/jpeg"
+
+                    alt = (
+                        msg["content"]["data"]
+                        .get("text/plain", "")
+                        .replace('"', "&quot;")
+                    )
 
-                if (
-                    msg["msg_type"] == "status"
-                    and msg["content"]["execution_state"] == "idle"
-                ):
-                    if content != "":
-                        yield event.FunctionOutput(
-                            id=stream_id,
-                            name="run_code",
-                            content=content,
-                            source=source,
-                            created_at=stime,
-                        )
-                    if result is not None:
-                        yield result
-                    return
+                    yield event.FunctionOutput(
+                        id=uuid.uuid4(),
+                        name="run_code",
+                        content=(
+                            "<img"
+                            f" src=\"data:{usetype};base64,{msg['content']['data'][usetype]}\""
+                            f' alt="{alt}" />'
+                        ),
+                        source=source,
+                        created_at=datetime.now(),
+                    )
+                    continue
+
+                yield event.FunctionOutput(
+                    id=uuid.uuid4(),
+                    name="run_code",
+                    content="```json\n"
+                    + json.dumps(msg["content"]["data"], sort_keys=True, indent=4)
+                    + "\n```",
+                    source=source,
+                    created_at=datetime.now(),
+                )
+
+            if msg["msg_type"] == "execute_result":
+                result = event.FunctionOutput(
+                    id=uuid.uuid4(),
+                    name="run_code",
+                    content=msg["content"]["data"]["text/plain"],
+                    source=source,
+                    created_at=datetime.now(),
+                )
+
+            if (
+                msg["msg_type"] == "status"
+                and msg["content"]["execution_state"] == "idle"
+            ):
+                if output.size > 0:
+                    yield event.FunctionOutput(
+                        id=stream_id,
+                        name="run_code",
+                        content=output.getvalue(),
+                        source=source,
+                        created_at=stime,
+                    )
+                if result is not None:
+                    yield result
+                if interrupted:
+                    yield event.Error(
+                        source=source,
+                        content=(
+                            f"Execution timed out after {self.options.timeout:g}"
+                            " seconds, and was interrupted."
+                        ),
+                        code="timeout",
+                    )
+                return
@@ -4,7 +4,7 @@ from zoneinfo import ZoneInfo
 import event
 from auth import User
 from history import HistoryDB
-from note import NoteDB
+from note import AsyncNoteDB, NoteDB
 from thread import Thread
 
 
@@ -29,7 +29,7 @@ async def debug_main() -> None:
         return
 
     ns = uuid.uuid5(uuid.NAMESPACE_DNS, "notes")
-    notes = NoteDB("./notes", ns)
+    notes = AsyncNoteDB(NoteDB("./notes", ns))
     history = HistoryDB("./history.db")
 
     thread = Thread(
@@ -44,6 +44,7 @@ async def debug_main() -> None:
     await thread.send_message(sys.argv[1])
 
     await thread.shutdown()
+    notes.close()
 
 
 async def debug_jupyter() -> None:
@@ -0,0 +1,482 @@
+import asyncio
+import hashlib
+import math
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from collections.abc import Callable, Sequence
+from concurrent.futures import Future
+from typing import Protocol
+
+Embedding = list[float]
+EmbeddingFunction = Callable[[list[str]], list[Embedding]]
+
+
+class EmbeddingBackend(Protocol):
+    """Model to convert texts to embeddings."""
+
+    # Name of the model. Used as a key of caches and indexes.
+    model: str
+
+    # Spec to create the same backend by `create_backend`.
+    spec: str
+
+    # Ratio of typical cosine distances to text-embedding-ada-002's.
+    distance_scale: float
+
+    def __call__(self, texts: list[str]) -> list[Embedding]:
+        ...
+
+
+class OpenAIEmbedding:
+    """Embedding backend using OpenAI API."""
+
+    distance_scale = 1.0
+
+    def __init__(self, model: str = "text-embedding-ada-002") -> None:
+        from chromadb.utils import embedding_functions
+
+        self.model = model
+        self.spec = f"openai:{model}"
+        self.__ef = embedding_functions.OpenAIEmbeddingFunction(
+            api_key=os.environ["OPENAI_API_KEY"],
+            model_name=model,
+        )
+
+    def __call__(self, texts: list[str]) -> list[Embedding]:
+        return [list(map(float, x)) for x in self.__ef(texts)]
+
+
+class ONNXEmbedding:
+    """Embedding backend using all-MiniLM-L6-v2 on CPU.
+
+    The model is downloaded to `~/.cache/chroma` at the first use.
+    """
+
+    model = "all-MiniLM-L6-v2"
+    spec = "onnx"
+    distance_scale = 3.0
+
+    def __init__(self) -> None:
+        from chromadb.utils import embedding_functions
+
+        self.__ef = embedding_functions.ONNXMiniLM_L6_V2()
+
+    def __call__(self, texts: list[str]) -> list[Embedding]:
+        return [list(map(float, x)) for x in self.__ef(texts)]
+
+
+class HashingEmbedding:
+    """Embedding backend using feature hashing of words and character trigrams.
+
+    This needs no model and no network, so it is useful as a fallback and
+    for testing.
+
+    >>> ef = HashingEmbedding(dim=64)
+    >>> a, b, c = ef(["I like apples", "I like an apple", "The car is red"])
+    >>> len(a)
+    64
+    >>> round(sum(x * x for x in a), 6)
+    1.0
+    >>> dot = lambda x, y: sum(p * q for p, q in zip(x, y))
+    >>> dot(a, b) > dot(a, c)
+    True
+    """
+
+    distance_scale = 4.0
+
+    def __init__(self, dim: int = 512) -> None:
+        self.dim = dim
+        self.model = f"hashing-{dim}"
+        self.spec = f"hashing:{dim}"
+
+    def __features(self, text: str) -> list[str]:
+        features = []
+        for word in re.findall(r"\w+", text.lower()):
+            features.append(word)
+            padded = f" {word} "
+            features.extend(padded[i : i + 3] for i in range(len(padded) - 2))
+        return features
+
+    def __embed(self, text: str) -> Embedding:
+        vector = [0.0] * self.dim
+        for feature in self.__features(text):
+            h = int.from_bytes(
+                hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(),
+                "little",
+            )
+            vector[(h >> 1) % self.dim] += 1.0 if h & 1 else -1.0
+
+        norm = math.sqrt(sum(x * x for x in vector))
+        if norm == 0:
+            return vector
+        return [x / norm for x in vector]
+
+    def __call__(self, texts: list[str]) -> list[Embedding]:
+        return [self.__embed(text) for text in texts]
+
+
+def create_backend(spec: str) -> EmbeddingBackend:
+    """Create an embedding backend from a spec like `openai`, `onnx`, or `hashing`.
+
+    A model name or a dimension can follow after a colon, like
+    `openai:text-embedding-ada-002` or `hashing:256`.
+
+    >>> create_backend("hashing:256").model
+    'hashing-256'
+    >>> create_backend(create_backend("hashing").spec).model
+    'hashing-512'
+
+    >>> create_backend("unknown")
+    Traceback (most recent call last):
+        ...
+    ValueError: Unknown embedding backend: unknown
+    """
+
+    name, _, arg = spec.partition(":")
+
+    match name:
+        case "openai":
+            return OpenAIEmbedding(arg) if arg else OpenAIEmbedding()
+        case "onnx":
+            return ONNXEmbedding()
+        case "hashing":
+            return HashingEmbedding(int(arg)) if arg else HashingEmbedding()
+        case _:
+            raise ValueError(f"Unknown embedding backend: {spec}")
+
+
+class EmbeddingCache:
+    """Cache of embeddings keyed by model name and hash of text.
+
+    Recently used embeddings are kept in memory, and all embeddings are
+    stored in SQLite as float32 arrays.
+
+    >>> cache = EmbeddingCache(":memory:", max_entries=1)
+    >>> cache.get_many("model", ["hello", "world"])
+    [None, None]
+
+    >>> cache.put_many("model", ["hello", "world"], [[1.0, 2.0], [3.0, 4.0]])
+    >>> cache.get_many("model", ["hello", "world"])
+    [[1.0, 2.0], [3.0, 4.0]]
+    >>> cache.get_many("other", ["hello"])
+    [None]
+
+    >>> cache.stats()
+    {'hits': 2, 'misses': 3, 'hit_rate': 0.4, 'memory_entries': 1}
+    """
+
+    def __init__(self, path: str, max_entries: int = 10000) -> None:
+        """Initialize the cache.
+
+        :param path: Path to the database. `:memory:` for in-memory database.
+        :param max_entries: Number of embeddings to keep in memory.
+        """
+
+        self.max_entries = max_entries
+        self.__memory: OrderedDict[tuple[str, bytes], Embedding] = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__hits = 0
+        self.__misses = 0
+
+        self.__conn = sqlite3.connect(path, check_same_thread=False)
+
+        with self.__conn as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    model TEXT NOT NULL,
+                    hash BLOB NOT NULL,
+                    vector BLOB NOT NULL,
+                    PRIMARY KEY (model, hash)
+                )
+                """
+            )
+
+    @staticmethod
+    def __key(model: str, text: str) -> tuple[str, bytes]:
+        return model, hashlib.sha256(text.encode("utf-8")).digest()
+
+    def __remember(self, key: tuple[str, bytes], embedding: Embedding) -> None:
+        self.__memory[key] = embedding
+        self.__memory.move_to_end(key)
+        while len(self.__memory) > self.max_entries:
+            self.__memory.popitem(last=False)
+
+    def get_many(self, model: str, texts: Sequence[str]) -> list[Embedding | None]:
+        """Get cached embeddings. Missing embeddings are None."""
+
+        keys = [self.__key(model, text) for text in texts]
+        result: list[Embedding | None] = []
+
+        with self.__lock:
+            for key in keys:
+                embedding = self.__memory.get(key)
+
+                if embedding is None:
+                    row = self.__conn.execute(
+                        """
+                        SELECT vector FROM embeddings WHERE model = ? AND hash = ?
+                        """,
+                        key,
+                    ).fetchone()
+                    if row is not None:
+                        embedding = array("f", row[0]).tolist()
+
+                if embedding is None:
+                    self.__misses += 1
+                else:
+                    self.__hits += 1
+                    self.__remember(key, embedding)
+
+                result.append(embedding)
+
+        return result
+
+    def put_many(
+        self, model: str, texts: Sequence[str], embeddings: Sequence[Embedding]
+    ) -> None:
+        """Store embeddings."""
+
+        keys = [self.__key(model, text) for text in texts]
+
+        with self.__lock:
+            with self.__conn as conn:
+                conn.executemany(
+                    """
+                    REPLACE INTO embeddings (model, hash, vector) VALUES (?, ?, ?)
+                    """,
+                    [
+                        (model, hash, array("f", embedding).tobytes())
+                        for (model, hash), embedding in zip(keys, embeddings)
+                    ],
+                )
+
+            for key, embedding in zip(keys, embeddings):
+                self.__remember(key, list(embedding))
+
+    def stats(self) -> dict[str, int | float]:
+        """Get statistics of the cache."""
+
+        total = self.__hits + self.__misses
+
+        return {
+            "hits": self.__hits,
+            "misses": self.__misses,
+            "hit_rate": self.__hits / total if total > 0 else 0.0,
+            "memory_entries": len(self.__memory),
+        }
+
+    def optimize(self) -> None:
+        """Update statistics of the query planner where they are stale."""
+
+        with self.__lock:
+            self.__conn.execute("PRAGMA optimize=0x10002")
+
+
+class CachedEmbeddingFunction:
+    """Embedding function that looks up the cache before calling `function`.
+
+    >>> calls = []
+    >>> def embed(texts: list[str]) -> list[Embedding]:
+    ...     calls.append(texts)
+    ...     return [[float(len(x))] for x in texts]
+    >>> ef = CachedEmbeddingFunction(embed, "len", EmbeddingCache(":memory:"))
+
+    >>> ef(["a", "bb"])
+    [[1.0], [2.0]]
+    >>> ef(["bb", "ccc"])
+    [[2.0], [3.0]]
+    >>> calls
+    [['a', 'bb'], ['ccc']]
+    """
+
+    def __init__(
+        self, function: EmbeddingFunction, model: str, cache: EmbeddingCache
+    ) -> None:
+        self.function = function
+        self.model = model
+        self.cache = cache
+
+    def __call__(self, texts: list[str]) -> list[Embedding]:
+        result = self.cache.get_many(self.model, texts)
+
+        missing = list(dict.fromkeys(t for t, x in zip(texts, result) if x is None))
+        if len(missing) > 0:
+            embeddings = self.function(missing)
+            self.cache.put_many(self.model, missing, embeddings)
+            computed = dict(zip(missing, embeddings))
+            result = [
+                x if x is not None else computed[text] for text, x in zip(texts, result)
+            ]
+
+        return [x for x in result if x is not None]
+
+
+class EmbeddingBatcher:
+    """Embedding function that merges concurrent calls into batched calls.
+
+    Texts requested while a batch is being collected, for up to `max_delay`
+    seconds or `max_batch` texts, are embedded by one call of `function`,
+    and results are returned to each caller.
+
+    >>> calls = []
+    >>> def embed(texts: list[str]) -> list[Embedding]:
+    ...     calls.append(texts)
+    ...     return [[float(len(x))] for x in texts]
+    >>> batcher = EmbeddingBatcher(embed, max_delay=0.05)
+
+    >>> async def main() -> list[list[Embedding]]:
+    ...     return await asyncio.gather(
+    ...         batcher.aembed(["a", "bb"]),
+    ...         batcher.aembed(["ccc", "a"]),
+    ...     )
+    >>> asyncio.run(main())
+    [[[1.0], [2.0]], [[3.0], [1.0]]]
+    >>> calls
+    [['a', 'bb', 'ccc']]
+
+    >>> batcher(["dddd"])
+    [[4.0]]
+    >>> batcher.stats()
+    {'batches': 2, 'texts': 4, 'avg_batch_size': 2.0}
+    >>> batcher.close()
+
+    A backend returning too few embeddings fails the callers, and the
+    batcher keeps serving later calls.
+
+    >>> batcher = EmbeddingBatcher(lambda texts: [[1.0]] if "x" in texts else [[2.0]])
+    >>> batcher(["x", "y"])
+    Traceback (most recent call last):
+        ...
+    ValueError: Expected 2 embeddings, but got 1.
+    >>> batcher(["z"])
+    [[2.0]]
+    >>> batcher.close()
+    """
+
+    def __init__(
+        self,
+        function: EmbeddingFunction,
+        max_delay: float = 0.005,
+        max_batch: int = 256,
+    ) -> None:
+        """Initialize the batcher.
+
+        :param function: Embedding function to call with batches.
+        :param max_delay: Seconds to wait for other texts before calling.
+        :param max_batch: Maximum number of texts in a batch.
+        """
+
+        self.function = function
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+
+        self.__queue: queue.SimpleQueue[
+            tuple[list[str], Future[list[Embedding]]] | None
+        ] = queue.SimpleQueue()
+        self.__lock = threading.Lock()
+        self.__thread: threading.Thread | None = None
+        self.__batches = 0
+        self.__texts = 0
+
+    def __submit(self, texts: list[str]) -> Future[list[Embedding]]:
+        future: Future[list[Embedding]] = Future()
+
+        if len(texts) == 0:
+            future.set_result([])
+            return future
+
+        with self.__lock:
+            if self.__thread is None:
+                self.__thread = threading.Thread(
+                    target=self.__run, name="hexe-embedding-batcher", daemon=True
+                )
+                self.__thread.start()
+
+        self.__queue.put((texts, future))
+        return future
+
+    def __call__(self, texts: list[str]) -> list[Embedding]:
+        return self.__submit(list(texts)).result()
+
+    async def aembed(self, texts: list[str]) -> list[Embedding]:
+        return await asyncio.wrap_future(self.__submit(list(texts)))
+
+    def __run(self) -> None:
+        while True:
+            item = self.__queue.get()
+            if item is None:
+                return
+
+            requests = [item]
+            n_texts = len(item[0])
+            deadline = time.monotonic() + self.max_delay
+
+            while n_texts < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.__queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    self.__queue.put(None)
+                    break
+                requests.append(item)
+                n_texts += len(item[0])
+
+            self.__flush(requests)
+
+    def __flush(
+        self, requests: list[tuple[list[str], Future[list[Embedding]]]]
+    ) -> None:
+        # Any error is set to the futures, since an error escaping this kills
+        # the worker thread and leaves callers waiting forever.
+        try:
+            texts = list(dict.fromkeys(t for texts, _ in requests for t in texts))
+            result = self.function(texts)
+            if len(result) != len(texts):
+                raise ValueError(
+                    f"Expected {len(texts)} embeddings, but got {len(result)}."
+                )
+
+            embeddings = dict(zip(texts, result))
+            results = [[embeddings[t] for t in texts] for texts, _ in requests]
+        except Exception as err:
+            for _, future in requests:
+                if not future.done():
+                    future.set_exception(err)
+            return
+
+        self.__batches += 1
+        self.__texts += len(texts)
+
+        for (_, future), embedding in zip(requests, results):
+            # Cancelled by an awaiting caller.
+            if not future.done():
+                future.set_result(embedding)
+
+    def stats(self) -> dict[str, int | float]:
+        """Get statistics of the batcher."""
+
+        return {
+            "batches": self.__batches,
+            "texts": self.__texts,
+            "avg_batch_size": self.__texts / self.__batches if self.__batches else 0.0,
+        }
+
+    def close(self) -> None:
+        """Stop the worker thread after the queued texts are embedded."""
+
+        with self.__lock:
+            if self.__thread is not None:
+                self.__queue.put(None)
+                self.__thread.join()
+                self.__thread = None
@@ -7,6 +7,7 @@ from datetime import datetime, timezone
 from typing import Iterator, Literal, TypedDict
 
 from openaitypes import Message as OpenAIMessage
+from tokenizer import Tokenizer
 
 EventType = Literal[
     "user", "assistant", "function_call", "function_output", "status", "error"
@@ -21,6 +22,7 @@ class EventDictRequired(TypedDict):
 
 class EventDict(EventDictRequired, total=False):
     arguments: str
+    code: str
     content: str
     delta: Literal[True]
     generating: bool
@@ -137,6 +139,9 @@ class FunctionOutput(Event):
     source: uuid.UUID
     type: Literal["function_output"] = "function_output"
 
+    # Maximum number of tokens of the content to send to LLM.
+    max_tokens = 1024
+
     def __init__(
         self, source: uuid.UUID, name: str, content: str, *args, **kwargs
     ) -> None:
@@ -155,7 +160,8 @@ class FunctionOutput(Event):
 
     @property
     def short_content(self) -> str:
-        """The content without the URL of media.
+        """The content without the URL of media, and with the middle omitted
+        if it's longer than `max_tokens`.
         This value is used for the messages to send to LLM.
         """
 
@@ -170,7 +176,7 @@ class FunctionOutput(Event):
                 ' but the URL in the chat history has omitted.*/" />'
             )
 
-        return self.content
+        return Tokenizer().truncate(self.content, self.max_tokens)
 
 
 @dataclass(init=False)
@@ -199,20 +205,33 @@ class Status(Event):
 class Error(Event):
     content: str
     source: uuid.UUID | None
+    # Machine-readable kind of the error, like `timeout` or `out_of_memory`.
+    code: str | None
     type: Literal["error"] = "error"
 
-    def __init__(self, source: uuid.UUID, *args, content: str = "", **kwargs) -> None:
+    def __init__(
+        self,
+        source: uuid.UUID,
+        *args,
+        content: str = "",
+        code: str | None = None,
+        **kwargs,
+    ) -> None:
         self.content = content
         self.source = source
+        self.code = code
         super().__init__(*args, **kwargs)
         self.source = source
 
     def as_dict(self) -> EventDict:
-        return {
+        ev: EventDict = {
             **super().as_dict(),
             "content": self.content,
             "source": str(self.source),
         }
+        if self.code is not None:
+            ev["code"] = self.code
+        return ev
 
 
 def as_messages(events: list[Event]) -> Iterator[OpenAIMessage]:
@@ -7,7 +7,7 @@ from datetime import datetime, timezone
 from typing import Iterator, Literal
 
 import event
-from tokenizer import Tokenizer
+from tokenizer import TokenBudget, Tokenizer
 
 
 @dataclass
@@ -64,10 +64,18 @@ class HistoryDB:
                     content TEXT,
                     function_name TEXT,
                     function_arguments TEXT,
+                    error_code TEXT,
                     PRIMARY KEY (id, user_id)
                 )
             """
             )
+            columns = [x[1] for x in conn.execute("PRAGMA table_info(events)")]
+            if "error_code" not in columns:
+                conn.execute(
+                    """
+                    ALTER TABLE events ADD COLUMN error_code TEXT
+                    """
+                )
 
     def put(self, user_id: str, ev: event.Event) -> None:
         """Save a message to the database."""
@@ -141,8 +149,8 @@ class HistoryDB:
                 case event.Error():
                     conn.execute(
                         """
-                            REPLACE INTO events (user_id, id, source, created_at, type, content)
-                            VALUES (?, ?, ?, ?, ?, ?)
+                            REPLACE INTO events (user_id, id, source, created_at, type, content, error_code)
+                            VALUES (?, ?, ?, ?, ?, ?, ?)
                         """,
                         (
                             user_id,
@@ -151,6 +159,7 @@ class HistoryDB:
                             ev.created_at.timestamp(),
                             ev.type,
                             ev.content,
+                            ev.code,
                         ),
                     )
                 case _:
@@ -166,6 +175,25 @@ class HistoryDB:
     ) -> Iterator[EventRecord]:
         """Load chat history of the user, limit by number of messages."""
 
+        records = list(self.__load(user_id, limit, since, until, order))
+        counts = Tokenizer().count_many([text for _, text in records])
+
+        for (ev, _), n_tokens in zip(records, counts):
+            yield EventRecord(
+                event=ev,
+                n_tokens=n_tokens,
+            )
+
+    def __load(
+        self,
+        user_id: str,
+        limit: int,
+        since: datetime | None,
+        until: datetime | None,
+        order: Literal["ASC", "DESC"],
+    ) -> Iterator[tuple[event.Event, str]]:
+        """Load events of the user with the text to count tokens of."""
+
         if since is None:
             since = datetime.fromtimestamp(0, timezone.utc)
 
@@ -175,7 +203,7 @@ class HistoryDB:
         cursor = self.__conn.cursor()
         cursor.execute(
             f"""
-                SELECT id, created_at, type, content, function_name, function_arguments, source
+                SELECT id, created_at, type, content, function_name, function_arguments, source, error_code
                 FROM events
                 WHERE user_id = ? AND ? <= created_at AND created_at < ?
                 ORDER BY created_at {order}
@@ -192,9 +220,10 @@ class HistoryDB:
             function_name,
             function_arguments,
             source,
+            error_code,
         ) in cursor:
             ev: event.Event | None = None
-            n_tokens: int = 0
+            text: str = ""
 
             if content is not None:
                 content = str(content)
@@ -210,7 +239,7 @@ class HistoryDB:
                         created_at=datetime.fromtimestamp(created_at, timezone.utc),
                         content=content,
                     )
-                    n_tokens = Tokenizer().count(content)
+                    text = content
                 case "assistant":
                     ev = event.Assistant(
                         id=uuid.UUID(id),
@@ -218,7 +247,7 @@ class HistoryDB:
                         content=content,
                         source=uuid.UUID(source),
                     )
-                    n_tokens = Tokenizer().count(content)
+                    text = content
                 case "function_call":
                     ev = event.FunctionCall(
                         id=uuid.UUID(id),
@@ -227,13 +256,11 @@ class HistoryDB:
                         arguments=function_arguments,
                         source=uuid.UUID(source),
                     )
-                    n_tokens = Tokenizer().count(
-                        json.dumps(
-                            {
-                                "name": function_name,
-                                "arguments": function_arguments,
-                            }
-                        )
+                    text = json.dumps(
+                        {
+                            "name": function_name,
+                            "arguments": function_arguments,
+                        }
                     )
                 case "function_output":
                     ev = event.FunctionOutput(
@@ -243,40 +270,44 @@ class HistoryDB:
                         content=content,
                         source=uuid.UUID(source),
                     )
-                    n_tokens = Tokenizer().count(content)
+                    text = content
                 case "error":
                     ev = event.Error(
                         id=uuid.UUID(id),
                         created_at=datetime.fromtimestamp(created_at, timezone.utc),
                         content=content,
                         source=uuid.UUID(source),
+                        code=error_code,
                     )
-                    n_tokens = Tokenizer().count(content)
+                    text = content
                 case _:
                     continue
 
-            yield EventRecord(
-                event=ev,
-                n_tokens=n_tokens,
-            )
+            yield ev, text
+
+    def load_by_tokens(self, user_id: str, tokens_limit: int) -> Iterator[event.Event]:
+        """Load chat history of the user from the latest, limit by number of tokens.
 
-    def load_by_tokens(self, user_id: str, tokens_limit: int) -> Iterator[EventRecord]:
-        """Load chat history of the user, limit by total number of tokens."""
+        Tokens are estimated while the total is far from the limit, so events
+        are yielded without their counts. The latest event is always loaded,
+        even if it exceeds the limit.
+        """
 
-        n_tokens = 0
+        budget = TokenBudget(tokens_limit)
         until = None
+        first = True
 
-        while n_tokens < tokens_limit:
-            itr = self.load(user_id, limit=10, until=until, order="DESC")
+        while True:
+            itr = self.__load(user_id, 10, None, until, "DESC")
 
             n = 0
-            for rec in itr:
-                if n_tokens + rec.n_tokens > tokens_limit:
-                    break
+            for ev, text in itr:
+                if not budget.add(text) and not first:
+                    return
 
-                n_tokens += rec.n_tokens
-                until = rec.event.created_at
-                yield rec
+                first = False
+                until = ev.created_at
+                yield ev
 
                 n += 1
 
@@ -315,3 +346,8 @@ class HistoryDB:
             return None
 
         return ev.content
+
+    def optimize(self) -> None:
+        """Update statistics of the query planner where they are stale."""
+
+        self.__conn.execute("PRAGMA optimize=0x10002")
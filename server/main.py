@@ -1,41 +1,236 @@
 import asyncio
+import functools
 import json
+import logging
 import os
 import uuid
 from datetime import datetime, timezone
-from typing import AsyncIterator
+from typing import TYPE_CHECKING, AsyncIterator
 
 from fastapi import Cookie, Depends, FastAPI, HTTPException, Request, Response
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
 
 import event
-from auth import Auth, User
+from auth import Auth, Overloaded, PasswordHasher, TokenSigner, User
+from embedding import EmbeddingCache, create_backend
 from history import HistoryDB
-from note import NoteDB
+from monitor import LoopMonitor
+from note import AsyncNoteDB, NoteDB
+from output import output_path
+from profiler import Profiler
 from thread import Thread, ThreadManager
+from tokenizer import Tokenizer
+from warmup import Warmup, import_modules
+
+if TYPE_CHECKING:
+    from coderunner import HexeKernelSpecManager, KernelPool
+
+logger = logging.getLogger(__name__)
 
 app = FastAPI()
 history: HistoryDB | None = None
 thread_manager: ThreadManager | None = None
 auth: Auth | None = None
+embedding_cache: EmbeddingCache | None = None
+kernel_spec_manager: "HexeKernelSpecManager | None" = None
+kernel_pool: "KernelPool | None" = None
+monitor = LoopMonitor(
+    threshold=float(os.environ.get("HEXE_LOOP_LAG_THRESHOLD_MS", "100")) / 1000,
+)
+
+warmup = Warmup()
+
+background_tasks: list[asyncio.Task] = []
+
+ADMIN_USERS = [x for x in os.environ.get("HEXE_ADMIN_USERS", "").split(",") if x]
+
+KERNEL_POOL_LANGUAGES = [
+    x
+    for x in os.environ.get("HEXE_KERNEL_POOL_LANGUAGES", "python,bash").split(",")
+    if x
+]
+
+OUTPUT_DIR = "./db/outputs"
+
+
+async def cleanup_sessions(interval: float = 60) -> None:
+    while True:
+        # A failure such as a locked database must not stop later cleanups,
+        # which also reload tokens revoked by other workers.
+        try:
+            if auth is not None:
+                auth.cleanup()
+        except Exception:
+            logger.exception("Failed to clean up sessions")
+        await asyncio.sleep(interval)
+
+
+async def collect_notes(interval: float) -> None:
+    while True:
+        try:
+            if thread_manager is not None:
+                await thread_manager.notes.collect_garbage()
+        except Exception:
+            logger.exception("Failed to collect garbage of notes")
+        await asyncio.sleep(interval)
+
+
+async def import_heavy_modules() -> None:
+    modules = ["tiktoken", "openai", "jupyter_client"]
+    if os.environ.get("HEXE_NOTE_STORE") != "vector":
+        modules.append("chromadb")
+
+    await asyncio.to_thread(import_modules, modules)
+
+
+async def warmup_tokenizer() -> None:
+    await asyncio.to_thread(lambda: Tokenizer().count("warmup"))
+
+
+async def warmup_databases() -> None:
+    if history is not None:
+        history.optimize()
+    if embedding_cache is not None:
+        await asyncio.to_thread(embedding_cache.optimize)
+
+
+def create_kernel_spec_manager() -> "HexeKernelSpecManager":
+    from coderunner import HexeKernelSpecManager, ResourceLimits
+
+    return HexeKernelSpecManager(
+        HexeKernelSpecManager.parse_preload(os.environ.get("HEXE_KERNEL_PRELOAD", "")),
+        ResourceLimits(
+            cpus=(
+                float(os.environ.get("HEXE_KERNEL_CPUS", "1"))
+                if os.environ.get("HEXE_KERNEL_CPUS", "1")
+                else None
+            ),
+            memory=os.environ.get("HEXE_KERNEL_MEMORY", "2g") or None,
+            pids=(
+                int(os.environ.get("HEXE_KERNEL_PIDS", "512"))
+                if os.environ.get("HEXE_KERNEL_PIDS", "512")
+                else None
+            ),
+        ),
+    )
+
+
+async def start_kernel_pool() -> None:
+    global kernel_pool
+
+    from coderunner import KernelPool, start_kernel
+
+    max_size = int(os.environ.get("HEXE_KERNEL_POOL_MAX", "4"))
+
+    kernel_pool = KernelPool(
+        KERNEL_POOL_LANGUAGES,
+        min_size=min(int(os.environ.get("HEXE_KERNEL_POOL_MIN", "1")), max_size),
+        max_size=max_size,
+        shrink_interval=float(
+            os.environ.get("HEXE_KERNEL_POOL_SHRINK_INTERVAL", "600")
+        ),
+        start=functools.partial(start_kernel, kernel_spec_manager=kernel_spec_manager),
+    )
+    kernel_pool.start()
+
+
+async def open_notes() -> None:
+    global thread_manager
+
+    def open_db() -> NoteDB:
+        return NoteDB(
+            "./db/notes",
+            uuid.uuid5(uuid.NAMESPACE_DNS, "notes"),
+            cache=embedding_cache,
+            backend=create_backend(os.environ.get("HEXE_EMBEDDING", "openai")),
+            store=(
+                "vector" if os.environ.get("HEXE_NOTE_STORE") == "vector" else "chroma"
+            ),
+            shards=(
+                int(os.environ["HEXE_NOTE_SHARDS"])
+                if os.environ.get("HEXE_NOTE_SHARDS")
+                else None
+            ),
+            dedup_threshold=(
+                float(os.environ["HEXE_NOTE_DEDUP_THRESHOLD"])
+                if os.environ.get("HEXE_NOTE_DEDUP_THRESHOLD")
+                else None
+            ),
+        )
+
+    notes = AsyncNoteDB(await asyncio.to_thread(open_db))
+    if notes.db.pending_backend is not None:
+        await notes.reindex(rate_limit=float(os.environ.get("HEXE_REINDEX_RATE", "50")))
+
+    from coderunner import RunnerOptions, start_kernel
+
+    assert history is not None
+    thread_manager = ThreadManager(
+        history,
+        notes,
+        kernels=kernel_pool,
+        start_kernel=functools.partial(
+            start_kernel, kernel_spec_manager=kernel_spec_manager
+        ),
+        runner_options=RunnerOptions(
+            timeout=float(os.environ.get("HEXE_CODE_TIMEOUT", "60")),
+            max_output_bytes=int(os.environ.get("HEXE_OUTPUT_MAX_BYTES", "65536")),
+            output_dir=OUTPUT_DIR,
+        ),
+    )
+
+    background_tasks.append(
+        asyncio.create_task(
+            collect_notes(float(os.environ.get("HEXE_NOTE_GC_INTERVAL", "3600")))
+        )
+    )
 
 
 @app.on_event("startup")
-def startup() -> None:
+async def startup() -> None:
     global history
-    global thread_manager
     global auth
+    global embedding_cache
+    global kernel_spec_manager
+
+    monitor.start()
+
+    # Kernels run with the resource limits whether or not the pool starts, so
+    # a wrong configuration of them stops the server here.
+    kernel_spec_manager = create_kernel_spec_manager()
 
     os.makedirs("./db", exist_ok=True)
 
+    # Keep the tokenizer data next to the databases rather than in a temporary
+    # directory, so that the server starts without network once it's fetched.
+    os.environ.setdefault("TIKTOKEN_CACHE_DIR", os.path.abspath("./db/tiktoken"))
+
     history = HistoryDB("./db/history.db")
-    thread_manager = ThreadManager(
-        history,
-        NoteDB("./db/notes", uuid.uuid5(uuid.NAMESPACE_DNS, "notes")),
+    embedding_cache = EmbeddingCache("./db/embeddings.db")
+
+    auth = Auth(
+        "./db/auth.db",
+        hasher=PasswordHasher(
+            max_workers=int(os.environ.get("HEXE_HASH_WORKERS", "2")),
+            max_queue=int(os.environ.get("HEXE_HASH_QUEUE", "16")),
+        ),
+        signer=(
+            TokenSigner(TokenSigner.parse_keys(os.environ["HEXE_SESSION_KEYS"]))
+            if os.environ.get("HEXE_SESSION_KEYS")
+            else None
+        ),
     )
+    background_tasks.append(asyncio.create_task(cleanup_sessions()))
 
-    auth = Auth("./db/auth.db")
+    # Steps other than `notes` only make the first requests faster, and the
+    # server gets ready without them if they keep failing.
+    warmup.add("imports", import_heavy_modules, required=False)
+    warmup.add("tokenizer", warmup_tokenizer, required=False)
+    warmup.add("databases", warmup_databases, required=False)
+    warmup.add("kernels", start_kernel_pool, required=False)
+    warmup.add("notes", open_notes)
+    background_tasks.append(asyncio.create_task(warmup.run()))
 
     try:
         # DEBUG
@@ -47,9 +242,22 @@ def startup() -> None:
 
 @app.on_event("shutdown")
 async def shutdown() -> None:
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+
     if thread_manager is not None:
         await thread_manager.shutdown()
 
+    if kernel_pool is not None:
+        await kernel_pool.shutdown()
+
+    if auth is not None:
+        auth.hasher.shutdown()
+
+    await monitor.stop()
+
 
 async def userinfo(session: str | None = Cookie(None)) -> User:
     if auth is None:
@@ -63,6 +271,13 @@ async def userinfo(session: str | None = Cookie(None)) -> User:
         raise HTTPException(401, detail="Login required.")
 
 
+async def admininfo(user: User = Depends(userinfo)) -> User:
+    if user.id not in ADMIN_USERS:
+        raise HTTPException(403, detail="Admin privilege required.")
+
+    return user
+
+
 class LoginRequest(BaseModel):
     id: str
     password: str
@@ -72,18 +287,26 @@ class LoginResponse(BaseModel):
     message: str
 
 
-@app.post("/api/login")
+@app.post("/api/login", response_model=LoginResponse)
 async def login(
     request: LoginRequest,
     response: Response,
-) -> LoginResponse:
+) -> LoginResponse | JSONResponse:
     if auth is None:
         raise HTTPException(503, detail="Server not ready yet.")
 
     max_age = 365 * 24 * 60 * 60
 
     try:
-        token = auth.login(request.id, request.password, expires_in=max_age)
+        token = await auth.alogin(request.id, request.password, expires_in=max_age)
+    except Overloaded:
+        return JSONResponse(
+            status_code=429,
+            content={
+                "message": "Too many login requests. Please try again later.",
+            },
+            headers={"Retry-After": "1"},
+        )
     except ValueError:
         return JSONResponse(
             status_code=401,
@@ -102,9 +325,27 @@ async def login(
         secure=True,
     )
 
-    return {
-        "message": "Success",
-    }
+    return LoginResponse(message="Success")
+
+
+@app.post("/api/logout")
+async def logout(response: Response, session: str | None = Cookie(None)) -> None:
+    if auth is None:
+        raise HTTPException(503, detail="Server not ready yet.")
+
+    if session is not None:
+        auth.logout(session)
+
+    response.delete_cookie(
+        "session", path="/", httponly=True, samesite="strict", secure=True
+    )
+
+
+@app.get("/readyz")
+async def get_readiness() -> JSONResponse:
+    return JSONResponse(
+        status_code=200 if warmup.ready else 503, content=warmup.status()
+    )
 
 
 @app.get("/api/user")
@@ -112,6 +353,122 @@ async def get_user(user: User = Depends(userinfo)) -> User:
     return user
 
 
+@app.get("/api/outputs/{output_id}", response_class=PlainTextResponse)
+async def get_output(output_id: uuid.UUID, user: User = Depends(userinfo)) -> str:
+    try:
+        with open(
+            output_path(OUTPUT_DIR, user.id, str(output_id)), encoding="utf-8"
+        ) as f:
+            return await asyncio.to_thread(f.read)
+    except FileNotFoundError:
+        raise HTTPException(404, detail="Output not found.")
+
+
+@app.get("/api/metrics")
+async def get_metrics(user: User = Depends(admininfo)) -> dict:
+    return {
+        "loop": {
+            **monitor.stats(),
+            "recent_stalls": [x.as_dict() for x in monitor.stalls],
+        },
+        "embedding_cache": (
+            embedding_cache.stats() if embedding_cache is not None else None
+        ),
+        "embedding_batcher": (
+            thread_manager.notes.db.batcher.stats()
+            if thread_manager is not None
+            else None
+        ),
+        "note_gc": (
+            thread_manager.notes.db.gc_stats() if thread_manager is not None else None
+        ),
+        "tokenizer": Tokenizer().stats() if Tokenizer.loaded() else None,
+        "kernel_pool": kernel_pool.stats() if kernel_pool is not None else None,
+        "note_query_cache": (
+            thread_manager.notes.db.query_cache.stats()
+            if thread_manager is not None
+            else None
+        ),
+    }
+
+
+@app.get("/api/profile", response_class=PlainTextResponse)
+async def get_profile(
+    seconds: float = 10, interval: float = 0.005, user: User = Depends(admininfo)
+) -> str:
+    if not 0 < seconds <= 300:
+        raise HTTPException(400, detail="The seconds must be in (0, 300].")
+    if not 0.001 <= interval <= 1:
+        raise HTTPException(400, detail="The interval must be in [0.001, 1].")
+
+    try:
+        return await asyncio.to_thread(Profiler(interval).run, seconds)
+    except RuntimeError:
+        raise HTTPException(409, detail="Another profiling is running.")
+
+
+class ConsolidateNotesResponse(BaseModel):
+    removed_notes: int
+
+
+@app.post("/api/notes/consolidate")
+async def consolidate_notes(
+    threshold: float = 0.05,
+    user_id: str | None = None,
+    user: User = Depends(admininfo),
+) -> ConsolidateNotesResponse:
+    if thread_manager is None:
+        raise HTTPException(503, detail="Server not ready yet.")
+    if not 0 <= threshold <= 1:
+        raise HTTPException(400, detail="The threshold must be in [0, 1].")
+
+    removed = await thread_manager.notes.consolidate(
+        threshold, [user_id] if user_id is not None else None
+    )
+
+    return ConsolidateNotesResponse(removed_notes=removed)
+
+
+class ReindexNotesRequest(BaseModel):
+    embedding: str
+    rate_limit: float = 50
+
+
+@app.post("/api/notes/reindex")
+async def reindex_notes(
+    request: ReindexNotesRequest, user: User = Depends(admininfo)
+) -> dict:
+    if thread_manager is None:
+        raise HTTPException(503, detail="Server not ready yet.")
+    if request.rate_limit <= 0:
+        raise HTTPException(400, detail="The rate_limit must be positive.")
+
+    # Loading a model such as ONNX takes seconds.
+    try:
+        backend = await asyncio.to_thread(create_backend, request.embedding)
+    except KeyError as err:
+        raise HTTPException(400, detail=f"Missing configuration: {err}")
+    except ValueError as err:
+        raise HTTPException(400, detail=str(err))
+
+    try:
+        await thread_manager.notes.reindex(backend, request.rate_limit)
+    except RuntimeError:
+        raise HTTPException(409, detail="Re-indexing is running.")
+    except ValueError as err:
+        raise HTTPException(400, detail=str(err))
+
+    return thread_manager.notes.db.reindex_progress() or {}
+
+
+@app.get("/api/notes/reindex")
+async def get_reindex_notes(user: User = Depends(admininfo)) -> dict | None:
+    if thread_manager is None:
+        raise HTTPException(503, detail="Server not ready yet.")
+
+    return thread_manager.notes.db.reindex_progress()
+
+
 class EventsResponse(BaseModel):
     events: list[event.EventDict]
 
@@ -0,0 +1,170 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from dataclasses import dataclass
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class Stall:
+    """A callback that blocked the event loop longer than the threshold."""
+
+    started_at: float
+    duration: float
+    stack: str
+
+    def as_dict(self) -> dict[str, float | str]:
+        return {
+            "started_at": self.started_at,
+            "duration": self.duration,
+            "stack": self.stack,
+        }
+
+
+class LoopMonitor:
+    """Watchdog that measures the lag of the event loop.
+
+    A heartbeat coroutine wakes up every `interval` seconds and measures how
+    late it was woken up. A watchdog thread watches the heartbeat, and takes
+    a stack sample of the event loop thread when the heartbeat is late more
+    than `threshold` seconds, so that the blocking code can be found.
+
+    >>> async def main() -> LoopMonitor:
+    ...     monitor = LoopMonitor(interval=0.01, threshold=0.05)
+    ...     monitor.start()
+    ...     await asyncio.sleep(0.05)
+    ...     time.sleep(0.3)
+    ...     await asyncio.sleep(0.05)
+    ...     await monitor.stop()
+    ...     return monitor
+    >>> monitor = asyncio.run(main())
+
+    >>> monitor.stats()["stalls"]
+    1
+    >>> monitor.stats()["lag_max"] > 0.2
+    True
+    >>> "in main" in monitor.stalls[-1].stack
+    True
+    """
+
+    def __init__(
+        self, interval: float = 0.05, threshold: float = 0.1, max_stalls: int = 100
+    ) -> None:
+        """Initialize the monitor.
+
+        :param interval: Interval of the heartbeat in seconds.
+        :param threshold: Lag in seconds to treat as a stall.
+        :param max_stalls: Number of recent stalls to keep.
+        """
+
+        self.interval = interval
+        self.threshold = threshold
+        self.stalls: deque[Stall] = deque(maxlen=max_stalls)
+
+        self.__lock = threading.Lock()
+        self.__stopped = threading.Event()
+        self.__beat = time.monotonic()
+        self.__sample: tuple[float, str] | None = None
+        self.__task: asyncio.Task | None = None
+        self.__thread: threading.Thread | None = None
+        self.__loop_thread_id: int | None = None
+
+        self.__ticks = 0
+        self.__lag_total = 0.0
+        self.__lag_last = 0.0
+        self.__lag_max = 0.0
+        self.__stalls_total = 0
+
+    def start(self) -> None:
+        """Start monitoring the running event loop."""
+
+        self.__loop_thread_id = threading.get_ident()
+        self.__beat = time.monotonic()
+        self.__stopped.clear()
+
+        self.__task = asyncio.get_running_loop().create_task(self.__heartbeat())
+        self.__thread = threading.Thread(
+            target=self.__watch, name="hexe-loop-monitor", daemon=True
+        )
+        self.__thread.start()
+
+    async def stop(self) -> None:
+        """Stop monitoring."""
+
+        self.__stopped.set()
+
+        if self.__task is not None:
+            self.__task.cancel()
+            try:
+                await self.__task
+            except asyncio.CancelledError:
+                pass
+            self.__task = None
+
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+    async def __heartbeat(self) -> None:
+        while True:
+            with self.__lock:
+                self.__beat = time.monotonic()
+                self.__sample = None
+
+            await asyncio.sleep(self.interval)
+
+            with self.__lock:
+                lag = max(0.0, time.monotonic() - self.__beat - self.interval)
+                sample = self.__sample
+
+            self.__ticks += 1
+            self.__lag_total += lag
+            self.__lag_last = lag
+            self.__lag_max = max(self.__lag_max, lag)
+
+            if lag >= self.threshold:
+                self.__stalls_total += 1
+
+                if sample is not None:
+                    started_at, stack = sample
+                else:
+                    started_at, stack = time.time() - lag, "(stack was not captured)"
+
+                self.stalls.append(
+                    Stall(started_at=started_at, duration=lag, stack=stack)
+                )
+                logger.warning(
+                    "Event loop was blocked for %.0f ms:\n%s", lag * 1000, stack
+                )
+
+    def __watch(self) -> None:
+        while not self.__stopped.wait(self.threshold / 4):
+            with self.__lock:
+                late = time.monotonic() - self.__beat - self.interval
+                if late < self.threshold or self.__sample is not None:
+                    continue
+
+                frame = sys._current_frames().get(self.__loop_thread_id or 0)
+                if frame is None:
+                    continue
+
+                self.__sample = (
+                    time.time() - late,
+                    "".join(traceback.format_stack(frame)),
+                )
+
+    def stats(self) -> dict[str, float | int]:
+        """Get statistics of the event loop lag in seconds."""
+
+        return {
+            "ticks": self.__ticks,
+            "lag_last": self.__lag_last,
+            "lag_avg": self.__lag_total / self.__ticks if self.__ticks > 0 else 0.0,
+            "lag_max": self.__lag_max,
+            "stalls": self.__stalls_total,
+        }
@@ -1,14 +1,46 @@
+import asyncio
+import dataclasses
+import functools
+import glob
+import hashlib
+import logging
 import os
+import threading
 import time
 import uuid
+from collections import OrderedDict
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from datetime import datetime
+from typing import Literal, TypeVar
 
-import chromadb
-from chromadb.utils import embedding_functions
+import numpy as np
 
+from embedding import (
+    CachedEmbeddingFunction,
+    Embedding,
+    EmbeddingBackend,
+    EmbeddingBatcher,
+    EmbeddingCache,
+    EmbeddingFunction,
+    OpenAIEmbedding,
+    create_backend,
+)
+from notestore import (
+    ChromaNoteStore,
+    FullTextIndex,
+    NoteStore,
+    StoredNote,
+    VectorNoteStore,
+    reciprocal_rank_fusion,
+)
 from tokenizer import Tokenizer
 
+T = TypeVar("T")
+
+logger = logging.getLogger(__name__)
+
 
 @dataclass
 class Note:
@@ -56,28 +88,571 @@ class Note:
         self._n_tokens = Tokenizer().count(value)
 
 
+def collection_name(namespace: uuid.UUID, model: str) -> str:
+    """Get the name of the collection for the embedding model.
+
+    >>> ns = uuid.UUID("00000000-0000-0000-0000-000000000000")
+    >>> collection_name(ns, "text-embedding-ada-002")
+    '00000000-0000-0000-0000-000000000000'
+    >>> collection_name(ns, "hashing-512")
+    '00000000-0000-0000-0000-000000000000-9964f277'
+    """
+
+    if model == "text-embedding-ada-002":
+        return str(namespace)
+
+    return f"{namespace}-{hashlib.sha256(model.encode('utf-8')).hexdigest()[:8]}"
+
+
+def group_duplicates(vectors: np.ndarray, threshold: float) -> list[list[int]]:
+    """Group indexes of vectors within `threshold` cosine distance.
+
+    Each vector joins the group whose first vector is nearest, so that a
+    chain of slightly different vectors doesn't drift into one group.
+
+    >>> group_duplicates(np.array([[1, 0], [0, 1], [1, 0.01], [1, 1]]), 0.01)
+    [[0, 2], [1], [3]]
+    """
+
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    vectors = vectors / np.where(norms == 0, 1, norms)
+
+    firsts: list[int] = []
+    groups: list[list[int]] = []
+    for i, vector in enumerate(vectors):
+        if len(firsts) > 0:
+            distances = 1 - vectors[firsts] @ vector
+            nearest = int(np.argmin(distances))
+            if distances[nearest] <= threshold:
+                groups[nearest].append(i)
+                continue
+
+        firsts.append(i)
+        groups.append([i])
+
+    return groups
+
+
+def merge_notes(notes: list[StoredNote]) -> StoredNote:
+    """Merge duplicate notes into the last one, available until the latest expiry.
+
+    >>> merge_notes([
+    ...     StoredNote("1", "old", 0, 200, 1),
+    ...     StoredNote("2", "new", 100, 150, 1),
+    ... ])
+    StoredNote(id='2', content='new', created_at=100, expires_at=200, n_tokens=1, distance=None)
+    """
+
+    return dataclasses.replace(
+        notes[-1], expires_at=max(x.expires_at for x in notes), distance=None
+    )
+
+
+QueryKey = tuple[str, int, float]
+
+
+class QueryCache:
+    """Cache of query results per user.
+
+    All results of a user are invalidated when notes of the user are written,
+    and each result expires when the earliest expiring note in it expires.
+
+    >>> cache = QueryCache()
+    >>> note = StoredNote("1", "Alice likes tea", 0, 100, 5)
+
+    >>> cache.put("alice", ("tea", 10, 0.15), [note], cache.version("alice"))
+    >>> [x.id for x in cache.get("alice", ("tea", 10, 0.15), 50) or []]
+    ['1']
+    >>> cache.get("alice", ("tea", 10, 0.15), 100) is None
+    True
+
+    >>> cache.put("alice", ("tea", 10, 0.15), [note], cache.version("alice"))
+    >>> cache.invalidate("alice")
+    >>> cache.get("alice", ("tea", 10, 0.15), 50) is None
+    True
+
+    Results computed before an invalidation are not cached.
+
+    >>> version = cache.version("alice")
+    >>> cache.invalidate("alice")
+    >>> cache.put("alice", ("tea", 10, 0.15), [note], version)
+    >>> cache.get("alice", ("tea", 10, 0.15), 50) is None
+    True
+    """
+
+    def __init__(self, max_users: int = 1024, max_entries_per_user: int = 64) -> None:
+        """Initialize the cache.
+
+        :param max_users: Number of users to keep results of.
+        :param max_entries_per_user: Number of results to keep per user.
+        """
+
+        self.max_users = max_users
+        self.max_entries_per_user = max_entries_per_user
+
+        self.__lock = threading.Lock()
+        self.__entries: OrderedDict[
+            str, OrderedDict[QueryKey, tuple[float, list[StoredNote]]]
+        ] = OrderedDict()
+        self.__versions: dict[str, int] = {}
+        self.__hits = 0
+        self.__misses = 0
+
+    def version(self, user_id: str) -> int:
+        """Get the number of writes to notes of the user, to pass to `put`."""
+
+        with self.__lock:
+            return self.__versions.get(user_id, 0)
+
+    def get(
+        self, user_id: str, key: QueryKey, now: float, count_miss: bool = True
+    ) -> list[StoredNote] | None:
+        """Get the cached result, or None if it's not cached.
+
+        :param count_miss: Count a miss in statistics. False to look up before
+            another look-up that counts it.
+        """
+
+        with self.__lock:
+            entries = self.__entries.get(user_id)
+            entry = entries.get(key) if entries is not None else None
+
+            if entries is None or entry is None or entry[0] <= now:
+                if entries is not None and entry is not None:
+                    del entries[key]
+                if count_miss:
+                    self.__misses += 1
+                return None
+
+            self.__entries.move_to_end(user_id)
+            entries.move_to_end(key)
+            self.__hits += 1
+            return entry[1]
+
+    def put(
+        self, user_id: str, key: QueryKey, result: list[StoredNote], version: int
+    ) -> None:
+        """Cache the result.
+
+        :param version: Version of the user when the query started.
+        """
+
+        valid_until = min((x.expires_at for x in result), default=float("inf"))
+
+        with self.__lock:
+            if self.__versions.get(user_id, 0) != version:
+                return
+
+            entries = self.__entries.setdefault(user_id, OrderedDict())
+            self.__entries.move_to_end(user_id)
+            entries[key] = (valid_until, result)
+
+            while len(entries) > self.max_entries_per_user:
+                entries.popitem(last=False)
+            while len(self.__entries) > self.max_users:
+                self.__entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__entries.clear()
+
+    def invalidate(self, user_id: str) -> None:
+        with self.__lock:
+            self.__versions[user_id] = self.__versions.get(user_id, 0) + 1
+            self.__entries.pop(user_id, None)
+
+    def stats(self) -> dict[str, float | int]:
+        with self.__lock:
+            total = self.__hits + self.__misses
+            return {
+                "hits": self.__hits,
+                "misses": self.__misses,
+                "hit_rate": self.__hits / total if total > 0 else 0.0,
+                "users": len(self.__entries),
+            }
+
+
+class NoteIndex:
+    """An embedding model and a store of notes embedded by the model."""
+
+    def __init__(
+        self, backend: EmbeddingBackend, store: NoteStore, cache: EmbeddingCache | None
+    ) -> None:
+        self.backend = backend
+        self.store = store
+
+        self.batcher = EmbeddingBatcher(backend)
+        self.embed: EmbeddingFunction = self.batcher
+        if cache is not None:
+            self.embed = CachedEmbeddingFunction(self.batcher, backend.model, cache)
+
+    def close(self) -> None:
+        self.batcher.close()
+        self.store.close()
+
+
 class NoteDB:
-    """Database for storing notes."""
+    """Database for storing notes.
+
+    The embedding model in use is recorded in the database directory. When
+    a different model is given, the recorded model keeps serving until all
+    notes are re-embedded by `reindex`.
+    """
 
-    def __init__(self, path: str, namespace: uuid.UUID) -> None:
+    def __init__(
+        self,
+        path: str,
+        namespace: uuid.UUID,
+        cache: EmbeddingCache | None = None,
+        backend: EmbeddingBackend | None = None,
+        store: Literal["chroma", "vector"] = "chroma",
+        shards: int | None = None,
+        max_open_partitions: int = 256,
+        fulltext: bool = True,
+        dedup_threshold: float | None = None,
+    ) -> None:
         """Initialize the database.
 
         :param path: Path to the database.
         :param namespace: Namespace for generating UUID of notes.
+        :param cache: Cache of embeddings for saving and querying.
+        :param backend: Embedding model. OpenAI's text-embedding-ada-002 by default.
+        :param store: Storage of notes. `chroma` for chromadb, or `vector` for
+            memory-mapped vectors and SQLite. Notes in the chroma store are
+            copied to the vector store when it's opened at the first time.
+        :param shards: Number of partitions to hash users into. None for a
+            partition per user. Only for `chroma` store.
+        :param max_open_partitions: Number of partitions to keep opened.
+        :param fulltext: Search notes by both full-text and embedding.
+        :param dedup_threshold: Cosine distance for text-embedding-ada-002 to
+            treat a saved note as a paraphrase of an existing note, which is
+            replaced with the saved one. None to save all notes.
         """
 
         self.__ns = namespace
+        self.__path = path
+        self.__cache = cache
+        self.__store_type = store
+        self.__shards = shards
+        self.__max_open_partitions = max_open_partitions
+        self.dedup_threshold = dedup_threshold
+        self.query_cache = QueryCache()
 
-        db = chromadb.PersistentClient(path)
-        ef = embedding_functions.OpenAIEmbeddingFunction(
-            api_key=os.environ["OPENAI_API_KEY"],
-            model_name="text-embedding-ada-002",
-        )
-        self.__collection = db.get_or_create_collection(
-            str(namespace),
-            embedding_function=ef,
-            metadata={"hnsw:space": "cosine"},
-        )
+        backend = backend if backend is not None else OpenAIEmbedding()
+
+        # Model to re-embed notes with, if it differs from the recorded one.
+        self.pending_backend: EmbeddingBackend | None = None
+
+        os.makedirs(path, exist_ok=True)
+        self.__spec_path = os.path.join(path, f"{namespace}.embedding")
+        if os.path.exists(self.__spec_path):
+            with open(self.__spec_path) as f:
+                spec = f.read().strip()
+            if spec != backend.spec:
+                self.pending_backend = backend
+                backend = create_backend(spec)
+        else:
+            self.__record_spec(backend.spec)
+
+        # Writes hold this lock, so that they go to both indexes consistently
+        # while re-indexing.
+        self.__write_lock = threading.RLock()
+        self.__index = self.__open_index(backend)
+        self.__shadow: NoteIndex | None = None
+        self.__retired: list[NoteIndex] = []
+
+        self.__reindex_thread: threading.Thread | None = None
+        self.__reindex_stop = threading.Event()
+        self.__reindex_progress: dict[str, str | float | int | None] | None = None
+
+        self.__gc_runs = 0
+        self.__gc_expired = 0
+        self.__gc_reclaimed: int | None = 0
+        self.__gc_last_run_at: float | None = None
+
+        self.__fulltext: FullTextIndex | None = None
+        if fulltext:
+            # The index doesn't depend on the embedding model, and is kept
+            # across re-indexing. Older versions made one per model.
+            for name in glob.glob(os.path.join(path, f"{namespace}-*.fts.db")):
+                os.remove(name)
+
+            self.__fulltext = FullTextIndex(os.path.join(path, f"{namespace}.fts.db"))
+            if not self.__fulltext.filled:
+                self.__fulltext.fill(
+                    (user_id, stored)
+                    for user_id, stored, _ in self.__index.store.scan()
+                )
+
+    @property
+    def backend(self) -> EmbeddingBackend:
+        """Embedding model in use."""
+
+        return self.__index.backend
+
+    @property
+    def batcher(self) -> EmbeddingBatcher:
+        return self.__index.batcher
+
+    def __open_index(self, backend: EmbeddingBackend) -> NoteIndex:
+        name = collection_name(self.__ns, backend.model)
+
+        store: NoteStore
+        match self.__store_type:
+            case "chroma":
+                store = ChromaNoteStore(
+                    self.__path,
+                    name,
+                    shards=self.__shards,
+                    max_open_partitions=self.__max_open_partitions,
+                )
+            case "vector":
+                vector_store = VectorNoteStore(
+                    os.path.join(self.__path, name),
+                    max_open_partitions=self.__max_open_partitions,
+                )
+                # Copy notes saved while the chroma store was in use.
+                if not vector_store.imported and os.path.exists(
+                    os.path.join(self.__path, "chroma.sqlite3")
+                ):
+                    legacy = ChromaNoteStore(self.__path, name, shards=self.__shards)
+                    copied = vector_store.import_notes(legacy)
+                    legacy.close()
+                    logger.info("Copied %d notes from chroma store", copied)
+                store = vector_store
+            case _:
+                raise ValueError(f"Unknown note store: {self.__store_type}")
+
+        return NoteIndex(backend, store, self.__cache)
+
+    def __record_spec(self, spec: str) -> None:
+        with open(f"{self.__spec_path}.tmp", "w") as f:
+            f.write(spec)
+        os.replace(f"{self.__spec_path}.tmp", self.__spec_path)
+
+    def reindex(
+        self,
+        backend: EmbeddingBackend | None = None,
+        rate_limit: float = 50,
+        batch_size: int = 100,
+    ) -> None:
+        """Start re-embedding all notes with another model in the background.
+
+        Notes are copied in batches to a shadow index of the new model, while
+        saved and deleted notes are written to both indexes. When all notes
+        are copied, the shadow index replaces the current one, and the new
+        model is recorded. An interrupted re-indexing resumes from the notes
+        already in the shadow index.
+
+        :param backend: Embedding model to re-embed with. `pending_backend` by
+            default.
+        :param rate_limit: Maximum number of notes to embed per second.
+        :param batch_size: Number of notes to embed at once.
+        :raises RuntimeError: If re-indexing is running.
+        :raises ValueError: If no model is given, or the model is in use.
+        """
+
+        with self.__write_lock:
+            if self.__reindex_thread is not None and self.__reindex_thread.is_alive():
+                raise RuntimeError("Re-indexing is running")
+
+            backend = backend if backend is not None else self.pending_backend
+            if backend is None:
+                raise ValueError("No embedding model to re-index with")
+            if backend.model == self.backend.model:
+                raise ValueError(f"Embedding model {backend.model} is in use")
+
+            self.__shadow = self.__open_index(backend)
+            self.__reindex_stop.clear()
+            self.__reindex_progress = {
+                "model": backend.model,
+                "state": "copying",
+                "total": None,
+                "processed": 0,
+                "embedded": 0,
+                "started_at": time.time(),
+                "finished_at": None,
+                "error": None,
+            }
+
+            self.__reindex_thread = threading.Thread(
+                target=self.__reindex,
+                args=(self.__shadow, rate_limit, batch_size),
+                name="hexe-note-reindex",
+                daemon=True,
+            )
+            self.__reindex_thread.start()
+
+    def reindex_progress(self) -> dict[str, str | float | int | None] | None:
+        """Get the progress of the last re-indexing, or None if never started."""
+
+        progress = self.__reindex_progress
+        return dict(progress) if progress is not None else None
+
+    def __reindex(self, shadow: NoteIndex, rate_limit: float, batch_size: int) -> None:
+        progress = self.__reindex_progress
+        assert progress is not None
+
+        try:
+            source = self.__index.store
+            progress["total"] = source.count()
+
+            for user_id, notes, _ in source.scan(batch_size):
+                if self.__reindex_stop.is_set():
+                    progress["state"] = "stopped"
+                    return
+
+                exists = shadow.store.exists(user_id, [x.id for x in notes])
+                missing = [x for x in notes if x.id not in exists]
+
+                if len(missing) > 0:
+                    started_at = time.monotonic()
+                    embeddings = shadow.embed([x.content for x in missing])
+
+                    with self.__write_lock:
+                        # Skip notes deleted or double-written while embedding.
+                        alive = source.exists(user_id, [x.id for x in missing])
+                        exists = shadow.store.exists(user_id, [x.id for x in missing])
+                        pairs = [
+                            (x, e)
+                            for x, e in zip(missing, embeddings)
+                            if x.id in alive and x.id not in exists
+                        ]
+                        if len(pairs) > 0:
+                            shadow.store.add(
+                                user_id, [x for x, _ in pairs], [e for _, e in pairs]
+                            )
+
+                    progress["embedded"] = int(progress["embedded"] or 0) + len(missing)
+                    self.__reindex_stop.wait(
+                        len(missing) / rate_limit - (time.monotonic() - started_at)
+                    )
+
+                progress["processed"] = int(progress["processed"] or 0) + len(notes)
+
+            # Notes copied by an interrupted re-indexing may have been deleted
+            # since then.
+            progress["state"] = "verifying"
+            stale: dict[str, list[str]] = {}
+            for user_id, notes, _ in shadow.store.scan(batch_size):
+                alive = source.exists(user_id, [x.id for x in notes])
+                stale.setdefault(user_id, []).extend(
+                    x.id for x in notes if x.id not in alive
+                )
+
+            with self.__write_lock:
+                for user_id, ids in stale.items():
+                    alive = source.exists(user_id, ids)
+                    ids = [x for x in ids if x not in alive]
+                    if len(ids) > 0:
+                        shadow.store.delete(user_id, ids)
+
+                self.__retired.append(self.__index)
+                self.__index = shadow
+                self.__shadow = None
+                self.__record_spec(shadow.backend.spec)
+                if (
+                    self.pending_backend is not None
+                    and self.pending_backend.model == shadow.backend.model
+                ):
+                    self.pending_backend = None
+
+            self.query_cache.clear()
+
+            progress["state"] = "done"
+            logger.info("Re-indexed notes with %s", shadow.backend.model)
+        except Exception as err:
+            logger.exception("Failed to re-index notes with %s", shadow.backend.model)
+            progress["state"] = "failed"
+            progress["error"] = str(err)
+        finally:
+            progress["finished_at"] = time.time()
+
+            with self.__write_lock:
+                if self.__shadow is shadow:
+                    self.__shadow = None
+                    self.__retired.append(shadow)
+
+    def collect_garbage(
+        self, batch_size: int = 500, max_garbage_ratio: float = 0.25
+    ) -> dict[str, int | None]:
+        """Delete expired notes, and compact the store.
+
+        Notes are deleted in batches, so that queries can run in between.
+        Compaction is skipped while re-indexing, as it moves notes under the
+        running scan.
+
+        :param batch_size: Number of notes to delete at once.
+        :param max_garbage_ratio: Ratio of deleted notes in a partition to
+            tolerate without compaction.
+        :return: Number of deleted notes and reclaimed bytes. Reclaimed bytes
+            are None if the store can't compact.
+        """
+
+        now = time.time()
+        expired = 0
+
+        while True:
+            batch = self.__index.store.expired(now, batch_size)
+
+            groups: dict[str, list[str]] = {}
+            for user_id, id in batch:
+                groups.setdefault(user_id, []).append(id)
+            for user_id, ids in groups.items():
+                self.__delete(user_id, ids)
+
+            expired += len(batch)
+            if len(batch) < batch_size:
+                break
+
+        reclaimed: int | None = 0
+        with self.__write_lock:
+            if self.__shadow is None:
+                reclaimed = self.__index.store.compact(max_garbage_ratio)
+        if self.__fulltext is not None and expired > 0:
+            self.__fulltext.optimize()
+
+        self.__gc_runs += 1
+        self.__gc_expired += expired
+        if reclaimed is None:
+            self.__gc_reclaimed = None
+        elif self.__gc_reclaimed is not None:
+            self.__gc_reclaimed += reclaimed
+        self.__gc_last_run_at = now
+
+        if reclaimed is not None:
+            logger.info(
+                "Deleted %d expired notes, and reclaimed %d bytes", expired, reclaimed
+            )
+        else:
+            logger.info("Deleted %d expired notes, and compacted nothing", expired)
+
+        return {"expired_notes": expired, "reclaimed_bytes": reclaimed}
+
+    def gc_stats(self) -> dict[str, float | int | None]:
+        """Get total statistics of `collect_garbage`.
+
+        Reclaimed bytes are None if the store can't compact.
+        """
+
+        return {
+            "runs": self.__gc_runs,
+            "expired_notes": self.__gc_expired,
+            "reclaimed_bytes": self.__gc_reclaimed,
+            "last_run_at": self.__gc_last_run_at,
+        }
+
+    def close(self) -> None:
+        """Stop background workers."""
+
+        self.__reindex_stop.set()
+        if self.__reindex_thread is not None:
+            self.__reindex_thread.join()
+
+        for index in [self.__index, *self.__retired]:
+            index.close()
+        if self.__fulltext is not None:
+            self.__fulltext.close()
 
     def save(self, user_id: str, notes: list[Note]) -> None:
         """Save notes to the database.
@@ -86,29 +661,125 @@ class NoteDB:
         :param notes: List of notes to save.
         """
 
+        index = self.__index
+
         user_ns = uuid.uuid5(self.__ns, user_id)
         ids = [str(uuid.uuid5(user_ns, x.content)) for x in notes]
 
-        exists = self.__collection.get(ids=ids)
-        notes = [note for note, id_ in zip(notes, ids) if id_ not in exists["ids"]]
-        ids = [id_ for id_ in ids if id_ not in exists["ids"]]
+        exists = index.store.exists(user_id, ids)
+        notes = [note for note, id_ in zip(notes, ids) if id_ not in exists]
+        ids = [id_ for id_ in ids if id_ not in exists]
 
         if len(notes) == 0:
             return
 
-        self.__collection.add(
-            documents=[x.content for x in notes],
-            metadatas=[
-                {
-                    "user_id": user_id,
-                    "created_at": x.created_at.timestamp(),
-                    "expires_at": x.expires_at.timestamp(),
-                    "n_tokens": Tokenizer().count(x.content),
-                }
-                for x in notes
-            ],
-            ids=ids,
-        )
+        stored = [
+            StoredNote(
+                id=id_,
+                content=x.content,
+                created_at=x.created_at.timestamp(),
+                expires_at=x.expires_at.timestamp(),
+                n_tokens=x.n_tokens,
+            )
+            for x, id_ in zip(notes, ids)
+        ]
+
+        embeddings = index.embed([x.content for x in notes])
+
+        if self.dedup_threshold is not None:
+            stored, embeddings = self.__replace_duplicates(
+                index,
+                user_id,
+                stored,
+                embeddings,
+                self.dedup_threshold * index.backend.distance_scale,
+            )
+
+        self.__add(user_id, stored, {index: embeddings})
+
+    def __replace_duplicates(
+        self,
+        index: NoteIndex,
+        user_id: str,
+        notes: list[StoredNote],
+        embeddings: list[Embedding],
+        threshold: float,
+    ) -> tuple[list[StoredNote], list[Embedding]]:
+        """Merge paraphrases in new notes, and delete existing notes they replace."""
+
+        merged_notes: list[StoredNote] = []
+        merged_embeddings: list[Embedding] = []
+        replaced: list[str] = []
+
+        for group in group_duplicates(np.array(embeddings), threshold):
+            note = merge_notes([notes[i] for i in group])
+            embedding = embeddings[group[-1]]
+
+            for x in index.store.query(user_id, embedding, 1, time.time()):
+                if x.distance is not None and x.distance <= threshold:
+                    note = merge_notes([x, note])
+                    replaced.append(x.id)
+
+            merged_notes.append(note)
+            merged_embeddings.append(embedding)
+
+        if len(replaced) > 0:
+            self.__delete(user_id, list(dict.fromkeys(replaced)))
+
+        return merged_notes, merged_embeddings
+
+    def __add(
+        self,
+        user_id: str,
+        notes: list[StoredNote],
+        embeddings: dict[NoteIndex, list[Embedding]],
+    ) -> None:
+        """Add notes to the index and the shadow index if re-indexing.
+
+        :param embeddings: Embeddings already computed for each index.
+        """
+
+        contents = [x.content for x in notes]
+
+        shadow = self.__shadow
+        if shadow is not None and shadow not in embeddings:
+            embeddings = embeddings | {shadow: shadow.embed(contents)}
+
+        with self.__write_lock:
+            try:
+                for index in [self.__index, self.__shadow]:
+                    if index is None:
+                        continue
+
+                    exists = index.store.exists(user_id, [x.id for x in notes])
+                    pairs = [
+                        (x, e)
+                        for x, e in zip(
+                            notes,
+                            embeddings.get(index) or index.embed(contents),
+                        )
+                        if x.id not in exists
+                    ]
+                    if len(pairs) > 0:
+                        index.store.add(
+                            user_id, [x for x, _ in pairs], [e for _, e in pairs]
+                        )
+
+                if self.__fulltext is not None:
+                    self.__fulltext.add(user_id, notes)
+            finally:
+                self.query_cache.invalidate(user_id)
+
+    def __delete(self, user_id: str, ids: list[str]) -> None:
+        with self.__write_lock:
+            try:
+                self.__index.store.delete(user_id, ids)
+                if self.__shadow is not None:
+                    self.__shadow.store.delete(user_id, ids)
+                if self.__fulltext is not None:
+                    self.__fulltext.delete(user_id, ids)
+            finally:
+                self.query_cache.invalidate(user_id)
 
     def delete(self, user_id: str, ids: list[uuid.UUID]) -> None:
         """Delete notes from the database.
@@ -117,10 +788,63 @@ class NoteDB:
         :param ids: List of IDs of notes to delete.
         """
 
-        self.__collection.delete(
-            ids=[str(id) for id in ids],
-            where={"user_id": user_id},
-        )
+        self.__delete(user_id, [str(id) for id in ids])
+
+    def consolidate(
+        self, threshold: float = 0.05, user_ids: list[str] | None = None
+    ) -> int:
+        """Merge paraphrased notes saved before, into the latest one of each.
+
+        Embeddings are read from the store, so no embedding requests are made.
+
+        :param threshold: Cosine distance for text-embedding-ada-002 to treat
+            notes as paraphrases. Scaled for other models.
+        :param user_ids: IDs of users to consolidate notes of. None for all users.
+        :return: Number of removed notes.
+        """
+
+        index = self.__index
+        threshold *= index.backend.distance_scale
+        removed = 0
+
+        for user_id in index.store.users() if user_ids is None else user_ids:
+            notes: list[StoredNote] = []
+            embeddings: list[Embedding] = []
+            for _, batch, batch_embeddings in index.store.scan(user_id=user_id):
+                notes.extend(batch)
+                embeddings.extend(batch_embeddings)
+
+            order = sorted(range(len(notes)), key=lambda i: notes[i].created_at)
+            notes = [notes[i] for i in order]
+            embeddings = [embeddings[i] for i in order]
+
+            merged_notes: list[StoredNote] = []
+            merged_embeddings: list[Embedding] = []
+            deleted: list[str] = []
+
+            for group in group_duplicates(np.array(embeddings), threshold):
+                if len(group) == 1:
+                    continue
+
+                deleted.extend(notes[i].id for i in group)
+                merged_notes.append(merge_notes([notes[i] for i in group]))
+                merged_embeddings.append(embeddings[group[-1]])
+
+            if len(deleted) == 0:
+                continue
+
+            self.__delete(user_id, deleted)
+            self.__add(user_id, merged_notes, {index: merged_embeddings})
+            removed += len(deleted) - len(merged_notes)
+
+            logger.info(
+                "Merged %d notes of %s into %d notes",
+                len(deleted),
+                user_id,
+                len(merged_notes),
+            )
+
+        return removed
 
     def query(
         self, user_id: str, query: str, n_results: int = 10, threshold: float = 0.15
@@ -130,42 +854,148 @@ class NoteDB:
         :param user_id: ID of the user who owns the notes.
         :param query: Query string.
         :param n_results: Maximum number of results to return.
-        :param threshold: Threshold of similarity.
+        :param threshold: Threshold of cosine distance for text-embedding-ada-002.
+            Scaled for other models.
         """
 
-        result = self.__collection.query(
-            where={
-                "$and": [
-                    {"user_id": user_id},
-                    {"expires_at": {"$gt": time.time()}},  # type: ignore
-                ],
-            },
-            query_texts=[query],
-            n_results=n_results,
-        )
+        now = time.time()
+        key = (query, n_results, threshold)
+
+        cached = self.query_cache.get(user_id, key, now)
+        if cached is not None:
+            return [self.__note(x) for x in cached]
 
-        if (
-            result["ids"] is None
-            or result["documents"] is None
-            or result["metadatas"] is None
-            or result["distances"] is None
-        ):
+        version = self.query_cache.version(user_id)
+        index = self.__index
+        threshold *= index.backend.distance_scale
+
+        # Skip embedding the query for users without notes.
+        if not index.store.has_notes(user_id):
             return []
 
-        return [
-            Note(
-                id=uuid.UUID(id),
-                content=content,
-                created_at=datetime.fromtimestamp(float(metadata["created_at"])),
-                expires_at=datetime.fromtimestamp(float(metadata["expires_at"])),
-                n_tokens=int(metadata["n_tokens"]),
-                distance=distance,
-            )
-            for id, content, metadata, distance in zip(
-                result["ids"][0],
-                result["documents"][0],
-                result["metadatas"][0],
-                result["distances"][0],
-            )
-            if distance <= threshold
+        result = [
+            x
+            for x in index.store.query(user_id, index.embed([query])[0], n_results, now)
+            if x.distance is not None and x.distance <= threshold
         ]
+
+        if self.__fulltext is not None:
+            # Lexical hits have no distance to filter by `threshold`, and the
+            # index returns only ones covering enough of the query instead.
+            lexical = self.__fulltext.query(user_id, query, n_results, now)
+            found = {x.id: x for x in lexical} | {x.id: x for x in result}
+            result = [
+                found[id]
+                for id in reciprocal_rank_fusion(
+                    [[x.id for x in result], [x.id for x in lexical]]
+                )[:n_results]
+            ]
+
+        self.query_cache.put(user_id, key, result, version)
+
+        return [self.__note(x) for x in result]
+
+    def cached_query(
+        self, user_id: str, query: str, n_results: int = 10, threshold: float = 0.15
+    ) -> list[Note] | None:
+        """Get the cached result of `query`, or None if it's not cached."""
+
+        cached = self.query_cache.get(
+            user_id, (query, n_results, threshold), time.time(), count_miss=False
+        )
+        if cached is None:
+            return None
+
+        return [self.__note(x) for x in cached]
+
+    @staticmethod
+    def __note(x: StoredNote) -> Note:
+        return Note(
+            id=uuid.UUID(x.id),
+            content=x.content,
+            created_at=datetime.fromtimestamp(x.created_at),
+            expires_at=datetime.fromtimestamp(x.expires_at),
+            n_tokens=x.n_tokens,
+            distance=x.distance,
+        )
+
+
+class AsyncNoteDB:
+    """Asynchronous facade of NoteDB.
+
+    Operations are submitted to a dedicated thread pool as soon as called,
+    so they don't block the event loop and run while the caller does other
+    work until awaiting the result.
+    """
+
+    def __init__(self, db: NoteDB, max_workers: int = 4) -> None:
+        """Initialize the facade.
+
+        :param db: Database to operate.
+        :param max_workers: Number of threads to operate the database.
+        """
+
+        self.db = db
+        self.__executor = ThreadPoolExecutor(
+            max_workers, thread_name_prefix="hexe-notes"
+        )
+
+    def __submit(self, func: Callable[..., T], *args, **kwargs) -> asyncio.Future[T]:
+        return asyncio.get_running_loop().run_in_executor(
+            self.__executor, functools.partial(func, *args, **kwargs)
+        )
+
+    def save(self, user_id: str, notes: list[Note]) -> asyncio.Future[None]:
+        """Save notes to the database. See `NoteDB.save`."""
+
+        return self.__submit(self.db.save, user_id, notes)
+
+    def delete(self, user_id: str, ids: list[uuid.UUID]) -> asyncio.Future[None]:
+        """Delete notes from the database. See `NoteDB.delete`."""
+
+        return self.__submit(self.db.delete, user_id, ids)
+
+    def query(
+        self, user_id: str, query: str, n_results: int = 10, threshold: float = 0.15
+    ) -> asyncio.Future[list[Note]]:
+        """Search notes from the database. See `NoteDB.query`.
+
+        A cached result is returned without waiting for a worker thread.
+        """
+
+        cached = self.db.cached_query(user_id, query, n_results, threshold)
+        if cached is not None:
+            future: asyncio.Future[
+                list[Note]
+            ] = asyncio.get_running_loop().create_future()
+            future.set_result(cached)
+            return future
+
+        return self.__submit(
+            self.db.query, user_id, query, n_results=n_results, threshold=threshold
+        )
+
+    def collect_garbage(self) -> asyncio.Future[dict[str, int | None]]:
+        """Delete expired notes. See `NoteDB.collect_garbage`."""
+
+        return self.__submit(self.db.collect_garbage)
+
+    def consolidate(
+        self, threshold: float = 0.05, user_ids: list[str] | None = None
+    ) -> asyncio.Future[int]:
+        """Merge paraphrased notes. See `NoteDB.consolidate`."""
+
+        return self.__submit(self.db.consolidate, threshold, user_ids)
+
+    def reindex(
+        self, backend: EmbeddingBackend | None = None, rate_limit: float = 50
+    ) -> asyncio.Future[None]:
+        """Start re-embedding all notes. See `NoteDB.reindex`."""
+
+        return self.__submit(self.db.reindex, backend, rate_limit)
+
+    def close(self) -> None:
+        """Wait for running operations, and stop background workers."""
+
+        self.__executor.shutdown(wait=True)
+        self.db.close()
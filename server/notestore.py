@@ -0,0 +1,1207 @@
+import hashlib
+import logging
+import math
+import os
+import re
+import sqlite3
+import threading
+from collections import OrderedDict
+from collections.abc import Iterable, Iterator
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Literal, Protocol, overload
+
+import hnswlib  # type: ignore
+import numpy as np
+
+from embedding import Embedding
+
+if TYPE_CHECKING:
+    from chromadb.api.models.Collection import Collection
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class StoredNote:
+    """A note as stored in NoteStore."""
+
+    id: str
+    content: str
+    created_at: float
+    expires_at: float
+    n_tokens: int
+    distance: float | None = None
+
+
+class NoteStore(Protocol):
+    """Storage of notes and their embeddings, partitioned by user."""
+
+    def exists(self, user_id: str, ids: list[str]) -> set[str]:
+        """Get IDs that are already stored."""
+        ...
+
+    def add(
+        self, user_id: str, notes: list[StoredNote], embeddings: list[Embedding]
+    ) -> None:
+        """Store notes that are not stored yet."""
+        ...
+
+    def delete(self, user_id: str, ids: list[str]) -> None:
+        """Delete notes."""
+        ...
+
+    def has_notes(self, user_id: str) -> bool:
+        """Whether the user may have notes, checked without searching."""
+        ...
+
+    def query(
+        self, user_id: str, embedding: Embedding, n_results: int, now: float
+    ) -> list[StoredNote]:
+        """Search notes not expired at `now`, ordered by cosine distance."""
+        ...
+
+    def scan(
+        self, batch_size: int = 500, user_id: str | None = None
+    ) -> Iterator[tuple[str, list[StoredNote], list[Embedding]]]:
+        """Iterate notes in batches of a user ID, notes and their embeddings.
+
+        :param batch_size: Maximum number of notes in a batch.
+        :param user_id: ID of the user to iterate notes of. None for all users.
+        """
+        ...
+
+    def users(self) -> list[str]:
+        """Get IDs of users who have notes."""
+        ...
+
+    def count(self) -> int:
+        """Get the number of notes of all users."""
+        ...
+
+    def expired(self, now: float, limit: int) -> list[tuple[str, str]]:
+        """Get up to `limit` pairs of a user ID and an ID of notes expired at `now`."""
+        ...
+
+    def compact(self, max_garbage_ratio: float) -> int | None:
+        """Remove space of deleted notes, and return the number of reclaimed bytes.
+
+        :param max_garbage_ratio: Ratio of deleted notes in a partition to
+            tolerate without compaction.
+        :return: Number of reclaimed bytes, or None if the store can't compact.
+        """
+        ...
+
+    def close(self) -> None:
+        ...
+
+
+class ChromaNoteStore:
+    """NoteStore using chromadb.
+
+    Notes are partitioned into collections per user, or per shard of users
+    if `shards` is given, so that searching cost depends on the number of
+    notes of the user rather than all users. Partitions are opened on demand.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        name: str,
+        shards: int | None = None,
+        max_open_partitions: int = 256,
+    ) -> None:
+        """Initialize the store.
+
+        :param path: Path to the database.
+        :param name: Prefix of names of collections.
+        :param shards: Number of partitions to hash users into. None for a
+            partition per user.
+        :param max_open_partitions: Number of partitions to keep opened.
+        """
+
+        self.shards = shards
+        self.max_open_partitions = max_open_partitions
+
+        import chromadb
+
+        self.__db = chromadb.PersistentClient(path)
+        self.__name = name
+        self.__partitions: OrderedDict[str, "Collection"] = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__warned_compact = False
+
+        self.__migrate()
+
+    def partition_name(self, user_id: str) -> str:
+        """Get the name of the collection that stores notes of the user."""
+
+        digest = hashlib.sha256(user_id.encode("utf-8")).hexdigest()
+
+        if self.shards is None:
+            return f"{self.__name}-u{digest[:16]}"
+        else:
+            return f"{self.__name}-s{int(digest[:8], 16) % self.shards:04d}"
+
+    @overload
+    def __partition(self, user_id: str) -> "Collection":
+        ...
+
+    @overload
+    def __partition(self, user_id: str, create: Literal[False]) -> "Collection | None":
+        ...
+
+    def __partition(self, user_id: str, create: bool = True) -> "Collection | None":
+        name = self.partition_name(user_id)
+
+        with self.__lock:
+            if name in self.__partitions:
+                self.__partitions.move_to_end(name)
+                return self.__partitions[name]
+
+            if create:
+                collection = self.__db.get_or_create_collection(
+                    name,
+                    embedding_function=None,
+                    metadata={"hnsw:space": "cosine"},
+                )
+            else:
+                try:
+                    collection = self.__db.get_collection(name, embedding_function=None)
+                except ValueError:
+                    return None
+
+            self.__partitions[name] = collection
+            while len(self.__partitions) > self.max_open_partitions:
+                self.__partitions.popitem(last=False)
+
+            return collection
+
+    def __migrate(self, batch_size: int = 500) -> None:
+        """Split the collection of all users, made by older versions, into partitions.
+
+        Embeddings are moved as is, so no embedding requests are made.
+        Migrated notes are deleted from the old collection one batch at a time,
+        so an interrupted migration continues at the next start.
+        """
+
+        try:
+            legacy = self.__db.get_collection(self.__name, embedding_function=None)
+        except ValueError:
+            return
+
+        while True:
+            batch = legacy.get(
+                limit=batch_size, include=["embeddings", "documents", "metadatas"]
+            )
+            if (
+                len(batch["ids"]) == 0
+                or batch["embeddings"] is None
+                or batch["documents"] is None
+                or batch["metadatas"] is None
+            ):
+                break
+
+            groups: dict[str, list[int]] = {}
+            for i, metadata in enumerate(batch["metadatas"]):
+                groups.setdefault(str(metadata["user_id"]), []).append(i)
+
+            for user_id, indexes in groups.items():
+                self.__partition(user_id).upsert(
+                    ids=[batch["ids"][i] for i in indexes],
+                    embeddings=[batch["embeddings"][i] for i in indexes],
+                    documents=[batch["documents"][i] for i in indexes],
+                    metadatas=[batch["metadatas"][i] for i in indexes],
+                )
+
+            legacy.delete(ids=batch["ids"])
+
+        self.__db.delete_collection(self.__name)
+
+    def exists(self, user_id: str, ids: list[str]) -> set[str]:
+        collection = self.__partition(user_id, create=False)
+        if collection is None:
+            return set()
+
+        return set(collection.get(ids=ids, include=[])["ids"])
+
+    def add(
+        self, user_id: str, notes: list[StoredNote], embeddings: list[Embedding]
+    ) -> None:
+        self.__partition(user_id).add(
+            ids=[x.id for x in notes],
+            embeddings=embeddings,  # type: ignore
+            documents=[x.content for x in notes],
+            metadatas=[
+                {
+                    "user_id": user_id,
+                    "created_at": x.created_at,
+                    "expires_at": x.expires_at,
+                    "n_tokens": x.n_tokens,
+                }
+                for x in notes
+            ],
+        )
+
+    def delete(self, user_id: str, ids: list[str]) -> None:
+        collection = self.__partition(user_id, create=False)
+        if collection is None:
+            return
+
+        collection.delete(ids=ids, where={"user_id": user_id})
+
+    def has_notes(self, user_id: str) -> bool:
+        # A shard may have notes only of other users, which is found by query.
+        collection = self.__partition(user_id, create=False)
+        return collection is not None and collection.count() > 0
+
+    def query(
+        self, user_id: str, embedding: Embedding, n_results: int, now: float
+    ) -> list[StoredNote]:
+        collection = self.__partition(user_id, create=False)
+        if collection is None:
+            return []
+
+        result = collection.query(
+            where={
+                "$and": [
+                    {"user_id": user_id},
+                    {"expires_at": {"$gt": now}},  # type: ignore
+                ],
+            },
+            query_embeddings=[embedding],  # type: ignore
+            n_results=n_results,
+        )
+
+        if (
+            result["ids"] is None
+            or result["documents"] is None
+            or result["metadatas"] is None
+            or result["distances"] is None
+        ):
+            return []
+
+        return [
+            StoredNote(
+                id=id,
+                content=content,
+                created_at=float(metadata["created_at"]),
+                expires_at=float(metadata["expires_at"]),
+                n_tokens=int(metadata["n_tokens"]),
+                distance=distance,
+            )
+            for id, content, metadata, distance in zip(
+                result["ids"][0],
+                result["documents"][0],
+                result["metadatas"][0],
+                result["distances"][0],
+            )
+        ]
+
+    def __collections(self) -> list[str]:
+        return [
+            x.name
+            for x in self.__db.list_collections()
+            if x.name.startswith(f"{self.__name}-")
+        ]
+
+    def scan(
+        self, batch_size: int = 500, user_id: str | None = None
+    ) -> Iterator[tuple[str, list[StoredNote], list[Embedding]]]:
+        if user_id is None:
+            names = self.__collections()
+        elif self.__partition(user_id, create=False) is not None:
+            names = [self.partition_name(user_id)]
+        else:
+            names = []
+
+        for name in names:
+            collection = self.__db.get_collection(name, embedding_function=None)
+
+            # Paging by offset skips notes when notes are deleted meanwhile,
+            # so page through IDs taken at first.
+            ids = collection.get(
+                where={"user_id": user_id} if user_id is not None else None,
+                include=[],
+            )["ids"]
+
+            for start in range(0, len(ids), batch_size):
+                batch = collection.get(
+                    ids=ids[start : start + batch_size],
+                    include=["embeddings", "documents", "metadatas"],
+                )
+                if (
+                    batch["embeddings"] is None
+                    or batch["documents"] is None
+                    or batch["metadatas"] is None
+                ):
+                    continue
+
+                groups: dict[str, list[int]] = {}
+                for i, metadata in enumerate(batch["metadatas"]):
+                    groups.setdefault(str(metadata["user_id"]), []).append(i)
+
+                for owner, indexes in groups.items():
+                    yield (
+                        owner,
+                        [
+                            StoredNote(
+                                id=batch["ids"][i],
+                                content=batch["documents"][i],
+                                created_at=float(batch["metadatas"][i]["created_at"]),
+                                expires_at=float(batch["metadatas"][i]["expires_at"]),
+                                n_tokens=int(batch["metadatas"][i]["n_tokens"]),
+                            )
+                            for i in indexes
+                        ],
+                        [list(map(float, batch["embeddings"][i])) for i in indexes],
+                    )
+
+    def users(self, batch_size: int = 500) -> list[str]:
+        users: set[str] = set()
+
+        for name in self.__collections():
+            collection = self.__db.get_collection(name, embedding_function=None)
+
+            offset = 0
+            while True:
+                batch = collection.get(
+                    limit=batch_size, offset=offset, include=["metadatas"]
+                )
+                if len(batch["ids"]) == 0 or batch["metadatas"] is None:
+                    break
+                offset += len(batch["ids"])
+
+                users.update(str(x["user_id"]) for x in batch["metadatas"])
+
+        return sorted(users)
+
+    def count(self) -> int:
+        return sum(
+            self.__db.get_collection(name, embedding_function=None).count()
+            for name in self.__collections()
+        )
+
+    def expired(self, now: float, limit: int) -> list[tuple[str, str]]:
+        result: list[tuple[str, str]] = []
+
+        for name in self.__collections():
+            if len(result) >= limit:
+                break
+
+            collection = self.__db.get_collection(name, embedding_function=None)
+
+            batch = collection.get(
+                where={"expires_at": {"$lte": now}},  # type: ignore
+                limit=limit - len(result),
+                include=["metadatas"],
+            )
+            if batch["metadatas"] is None:
+                continue
+
+            result.extend(
+                (str(metadata["user_id"]), id)
+                for id, metadata in zip(batch["ids"], batch["metadatas"])
+            )
+
+        return result
+
+    def compact(self, max_garbage_ratio: float) -> int | None:
+        # chromadb 0.4 marks deleted vectors in the HNSW index and never
+        # removes them, and provides no way to rebuild the index.
+        if not self.__warned_compact:
+            logger.warning(
+                "Deleted notes are not compacted in the chroma store."
+                " Use the vector store to reclaim their space."
+            )
+            self.__warned_compact = True
+        return None
+
+    def close(self) -> None:
+        pass
+
+
+class VectorPartition:
+    """Memory-mapped float32 vectors of notes of a user.
+
+    Vectors are appended to the file, and a row number (slot) identifies a
+    vector. Deleted vectors remain in the file until compaction.
+
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), "vectors.f32")
+    >>> partition = VectorPartition(path, 2, hnsw_threshold=100)
+    >>> partition.append(np.eye(2, dtype=np.float32)[[0, 1, 0]], set())
+    [0, 1, 2]
+    >>> partition.compact([1, 2])
+    8
+    >>> partition.search(np.array([1, 0], dtype=np.float32), [0, 1], 2)
+    [(1, 0.0), (0, 1.0)]
+    """
+
+    # Size of the candidate list of HNSW search. Larger is more accurate.
+    ef = 64
+
+    def __init__(self, path: str, dim: int, hnsw_threshold: int) -> None:
+        self.path = path
+        self.dim = dim
+        self.hnsw_threshold = hnsw_threshold
+        self.index: hnswlib.Index | None = None
+        self.__vectors: np.memmap | None = None
+
+    @property
+    def count(self) -> int:
+        """Number of slots including deleted ones."""
+
+        if not os.path.exists(self.path):
+            return 0
+        return os.path.getsize(self.path) // (4 * self.dim)
+
+    @property
+    def vectors(self) -> np.ndarray:
+        count = self.count
+        if count == 0:
+            return np.zeros((0, self.dim), dtype=np.float32)
+
+        if self.__vectors is None or self.__vectors.shape[0] != count:
+            self.__vectors = np.memmap(
+                self.path, dtype=np.float32, mode="r", shape=(count, self.dim)
+            )
+        return self.__vectors
+
+    def append(self, vectors: np.ndarray, live: set[int]) -> list[int]:
+        """Append vectors, and return their slots.
+
+        :param vectors: Normalized vectors to append.
+        :param live: Slots of notes that are not deleted.
+        """
+
+        start = self.count
+        with open(self.path, "ab") as f:
+            f.write(vectors.astype(np.float32).tobytes())
+        slots = list(range(start, start + len(vectors)))
+
+        if self.index is not None:
+            if self.index.get_max_elements() < start + len(vectors):
+                self.index.resize_index(
+                    max(2 * self.index.get_max_elements(), start + len(vectors))
+                )
+            self.index.add_items(vectors, slots)
+        elif start + len(vectors) >= self.hnsw_threshold:
+            self.build_index(live | set(slots))
+
+        return slots
+
+    def build_index(self, live: set[int]) -> None:
+        """Build HNSW index of the vectors.
+
+        :param live: Slots of notes that are not deleted.
+        """
+
+        vectors = self.vectors
+        index = hnswlib.Index(space="cosine", dim=self.dim)
+        index.init_index(max_elements=max(2 * len(vectors), 1024), M=16)
+        index.add_items(vectors, np.arange(len(vectors)))
+        for slot in range(len(vectors)):
+            if slot not in live:
+                index.mark_deleted(slot)
+        self.index = index
+
+    def remove(self, slots: list[int]) -> None:
+        if self.index is not None:
+            for slot in slots:
+                self.index.mark_deleted(slot)
+
+    def compact(self, live: list[int]) -> int:
+        """Rewrite the file only with live vectors, and return reclaimed bytes.
+
+        The vector at `live[i]` moves to the slot `i`. The file is replaced
+        atomically, and the HNSW index is rebuilt if it was built.
+
+        :param live: Slots of notes that are not deleted, in ascending order.
+        """
+
+        count = self.count
+        vectors = np.array(self.vectors[live], dtype=np.float32).reshape(-1, self.dim)
+
+        with open(f"{self.path}.tmp", "wb") as f:
+            f.write(vectors.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f"{self.path}.tmp", self.path)
+
+        self.__vectors = None
+        if self.index is not None:
+            self.build_index(set(range(len(live))))
+
+        return (count - len(live)) * 4 * self.dim
+
+    def search(
+        self, query: np.ndarray, slots: list[int], n_results: int
+    ) -> list[tuple[int, float]]:
+        """Search nearest vectors among `slots`.
+
+        :return: Pairs of a slot and a cosine distance, nearest first.
+        """
+
+        k = min(n_results, len(slots))
+        if k == 0:
+            return []
+
+        if self.index is not None:
+            allowed = set(slots)
+            self.index.set_ef(max(self.ef, k))
+            try:
+                labels, distances = self.index.knn_query(
+                    query, k=k, filter=lambda x: x in allowed
+                )
+            except RuntimeError:
+                # The graph search reached fewer than `k` allowed vectors,
+                # which happens when most of them are filtered out.
+                pass
+            else:
+                if len(labels[0]) == k:
+                    return [(int(x), float(d)) for x, d in zip(labels[0], distances[0])]
+
+        candidates = np.array(slots)
+        distances = 1 - self.vectors[candidates] @ query
+        top = np.argpartition(distances, k - 1)[:k]
+        top = top[np.argsort(distances[top])]
+        return [(int(candidates[i]), float(distances[i])) for i in top]
+
+
+class VectorNoteStore:
+    """NoteStore with memory-mapped vectors per user and metadata in SQLite.
+
+    Search is exact for small partitions, and uses an HNSW index built in
+    memory for partitions larger than `hnsw_threshold`. Partitions are loaded
+    on demand, and least recently used ones are evicted from memory.
+    """
+
+    def __init__(
+        self, path: str, max_open_partitions: int = 256, hnsw_threshold: int = 2000
+    ) -> None:
+        """Initialize the store.
+
+        :param path: Path to the directory to store files.
+        :param max_open_partitions: Number of partitions to keep in memory.
+        :param hnsw_threshold: Number of vectors to use HNSW index.
+        """
+
+        os.makedirs(path, exist_ok=True)
+
+        self.path = path
+        self.max_open_partitions = max_open_partitions
+        self.hnsw_threshold = hnsw_threshold
+
+        self.__lock = threading.RLock()
+        self.__partitions: OrderedDict[str, VectorPartition] = OrderedDict()
+        self.__conn = sqlite3.connect(
+            os.path.join(path, "notes.db"), check_same_thread=False
+        )
+
+        with self.__conn as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS notes (
+                    id TEXT PRIMARY KEY,
+                    user_id TEXT NOT NULL,
+                    slot INTEGER NOT NULL,
+                    content TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    expires_at REAL NOT NULL,
+                    n_tokens INTEGER NOT NULL
+                )
+                """
+            )
+            conn.execute(
+                """
+                CREATE INDEX IF NOT EXISTS notes_user_id ON notes (user_id, expires_at)
+                """
+            )
+            conn.execute(
+                """
+                CREATE INDEX IF NOT EXISTS notes_user_slot ON notes (user_id, slot)
+                """
+            )
+            conn.execute(
+                """
+                CREATE INDEX IF NOT EXISTS notes_expires_at ON notes (expires_at)
+                """
+            )
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS settings (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL
+                )
+                """
+            )
+            row = conn.execute(
+                "SELECT value FROM settings WHERE key = 'dim'"
+            ).fetchone()
+
+        self.dim: int | None = int(row[0]) if row is not None else None
+
+    def vector_path(self, user_id: str) -> str:
+        """Get the path to the vector file of the user."""
+
+        digest = hashlib.sha256(user_id.encode("utf-8")).hexdigest()
+        return os.path.join(self.path, f"{digest[:16]}.f32")
+
+    def __live_slots(self, user_id: str) -> set[int]:
+        return {
+            x[0]
+            for x in self.__conn.execute(
+                "SELECT slot FROM notes WHERE user_id = ?", (user_id,)
+            )
+        }
+
+    def __partition(self, user_id: str) -> VectorPartition | None:
+        if self.dim is None:
+            return None
+
+        if user_id in self.__partitions:
+            self.__partitions.move_to_end(user_id)
+            return self.__partitions[user_id]
+
+        partition = VectorPartition(
+            self.vector_path(user_id), self.dim, self.hnsw_threshold
+        )
+        if partition.count >= self.hnsw_threshold:
+            partition.build_index(self.__live_slots(user_id))
+
+        self.__partitions[user_id] = partition
+        while len(self.__partitions) > self.max_open_partitions:
+            self.__partitions.popitem(last=False)
+
+        return partition
+
+    def exists(self, user_id: str, ids: list[str]) -> set[str]:
+        with self.__lock:
+            return {
+                x[0]
+                for x in self.__conn.execute(
+                    f"""
+                    SELECT id FROM notes
+                    WHERE user_id = ? AND id IN ({", ".join("?" for _ in ids)})
+                    """,
+                    (user_id, *ids),
+                )
+            }
+
+    def add(
+        self, user_id: str, notes: list[StoredNote], embeddings: list[Embedding]
+    ) -> None:
+        vectors = np.array(embeddings, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors /= np.where(norms == 0, 1, norms)
+
+        with self.__lock:
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                with self.__conn as conn:
+                    conn.execute(
+                        "INSERT INTO settings (key, value) VALUES ('dim', ?)",
+                        (str(self.dim),),
+                    )
+            elif vectors.shape[1] != self.dim:
+                raise ValueError(
+                    f"Embedding dimension {vectors.shape[1]} does not match {self.dim}"
+                )
+
+            partition = self.__partition(user_id)
+            assert partition is not None
+
+            slots = partition.append(vectors, self.__live_slots(user_id))
+
+            with self.__conn as conn:
+                conn.executemany(
+                    """
+                    INSERT INTO notes
+                        (id, user_id, slot, content, created_at, expires_at, n_tokens)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    [
+                        (
+                            x.id,
+                            user_id,
+                            slot,
+                            x.content,
+                            x.created_at,
+                            x.expires_at,
+                            x.n_tokens,
+                        )
+                        for x, slot in zip(notes, slots)
+                    ],
+                )
+
+    def delete(self, user_id: str, ids: list[str]) -> None:
+        with self.__lock:
+            placeholders = ", ".join("?" for _ in ids)
+            with self.__conn as conn:
+                slots = [
+                    x[0]
+                    for x in conn.execute(
+                        f"""
+                        SELECT slot FROM notes
+                        WHERE user_id = ? AND id IN ({placeholders})
+                        """,
+                        (user_id, *ids),
+                    )
+                ]
+                conn.execute(
+                    f"""
+                    DELETE FROM notes WHERE user_id = ? AND id IN ({placeholders})
+                    """,
+                    (user_id, *ids),
+                )
+
+            if user_id in self.__partitions:
+                self.__partitions[user_id].remove(slots)
+
+    def has_notes(self, user_id: str) -> bool:
+        with self.__lock:
+            return (
+                self.__conn.execute(
+                    "SELECT 1 FROM notes WHERE user_id = ? LIMIT 1", (user_id,)
+                ).fetchone()
+                is not None
+            )
+
+    def query(
+        self, user_id: str, embedding: Embedding, n_results: int, now: float
+    ) -> list[StoredNote]:
+        with self.__lock:
+            rows = {
+                row[0]: row[1:]
+                for row in self.__conn.execute(
+                    """
+                    SELECT slot, id, content, created_at, expires_at, n_tokens
+                    FROM notes
+                    WHERE user_id = ? AND expires_at > ?
+                    """,
+                    (user_id, now),
+                )
+            }
+
+            partition = self.__partition(user_id)
+            if partition is None or len(rows) == 0:
+                return []
+
+            query = np.array(embedding, dtype=np.float32)
+            norm = np.linalg.norm(query)
+            if norm > 0:
+                query /= norm
+
+            found = partition.search(query, list(rows.keys()), n_results)
+
+        return [
+            StoredNote(
+                id=rows[slot][0],
+                content=rows[slot][1],
+                created_at=rows[slot][2],
+                expires_at=rows[slot][3],
+                n_tokens=rows[slot][4],
+                distance=distance,
+            )
+            for slot, distance in found
+        ]
+
+    def scan(
+        self, batch_size: int = 500, user_id: str | None = None
+    ) -> Iterator[tuple[str, list[StoredNote], list[Embedding]]]:
+        for owner in self.users() if user_id is None else [user_id]:
+            last_slot = -1
+
+            while True:
+                with self.__lock:
+                    rows = self.__conn.execute(
+                        """
+                        SELECT slot, id, content, created_at, expires_at, n_tokens
+                        FROM notes
+                        WHERE user_id = ? AND slot > ?
+                        ORDER BY slot
+                        LIMIT ?
+                        """,
+                        (owner, last_slot, batch_size),
+                    ).fetchall()
+
+                    partition = self.__partition(owner)
+                    if len(rows) == 0 or partition is None:
+                        break
+
+                    vectors = partition.vectors[[x[0] for x in rows]].tolist()
+
+                last_slot = rows[-1][0]
+
+                yield (
+                    owner,
+                    [
+                        StoredNote(
+                            id=row[1],
+                            content=row[2],
+                            created_at=row[3],
+                            expires_at=row[4],
+                            n_tokens=row[5],
+                        )
+                        for row in rows
+                    ],
+                    vectors,
+                )
+
+    @property
+    def imported(self) -> bool:
+        """Whether `import_notes` has finished."""
+
+        with self.__lock:
+            row = self.__conn.execute(
+                "SELECT value FROM settings WHERE key = 'imported'"
+            ).fetchone()
+        return row is not None
+
+    def import_notes(self, source: NoteStore, batch_size: int = 500) -> int:
+        """Copy notes and their embeddings from another store.
+
+        Embeddings are copied as is, so no embedding requests are made. Notes
+        stored already are skipped, so an interrupted import continues at the
+        next call.
+
+        :return: Number of copied notes.
+        """
+
+        copied = 0
+        for user_id, notes, embeddings in source.scan(batch_size):
+            exists = self.exists(user_id, [x.id for x in notes])
+            indexes = [i for i, x in enumerate(notes) if x.id not in exists]
+            if len(indexes) > 0:
+                self.add(
+                    user_id,
+                    [notes[i] for i in indexes],
+                    [embeddings[i] for i in indexes],
+                )
+                copied += len(indexes)
+
+        with self.__lock, self.__conn as conn:
+            conn.execute("REPLACE INTO settings (key, value) VALUES ('imported', '1')")
+
+        return copied
+
+    def users(self) -> list[str]:
+        with self.__lock:
+            return [
+                x[0]
+                for x in self.__conn.execute(
+                    "SELECT DISTINCT user_id FROM notes ORDER BY user_id"
+                )
+            ]
+
+    def count(self) -> int:
+        with self.__lock:
+            return self.__conn.execute("SELECT COUNT(*) FROM notes").fetchone()[0]
+
+    def expired(self, now: float, limit: int) -> list[tuple[str, str]]:
+        with self.__lock:
+            return self.__conn.execute(
+                "SELECT user_id, id FROM notes WHERE expires_at <= ? LIMIT ?",
+                (now, limit),
+            ).fetchall()
+
+    def compact(self, max_garbage_ratio: float) -> int:
+        with self.__lock:
+            users = self.users()
+            paths = {self.vector_path(user_id) for user_id in users}
+
+            # Files of users who have no notes contain only deleted vectors.
+            reclaimed = 0
+            for name in os.listdir(self.path):
+                path = os.path.join(self.path, name)
+                if name.endswith(".f32") and path not in paths:
+                    reclaimed += os.path.getsize(path)
+                    os.remove(path)
+                    for user_id in [
+                        k for k, v in self.__partitions.items() if v.path == path
+                    ]:
+                        del self.__partitions[user_id]
+
+        for user_id in users:
+            with self.__lock:
+                partition = self.__partition(user_id)
+                if partition is None:
+                    break
+
+                rows = self.__conn.execute(
+                    "SELECT id, slot FROM notes WHERE user_id = ? ORDER BY slot",
+                    (user_id,),
+                ).fetchall()
+                garbage = partition.count - len(rows)
+                if garbage == 0 or garbage < max_garbage_ratio * partition.count:
+                    continue
+
+                with self.__conn as conn:
+                    conn.executemany(
+                        "UPDATE notes SET slot = ? WHERE id = ?",
+                        [(slot, row[0]) for slot, row in enumerate(rows)],
+                    )
+                    reclaimed += partition.compact([x[1] for x in rows])
+
+        return reclaimed
+
+    def close(self) -> None:
+        with self.__lock:
+            self.__partitions.clear()
+            self.__conn.close()
+
+
+# Words too common to tell notes apart, which full-text search ignores.
+STOPWORDS = frozenset(
+    """
+    about above after again against all and any are because been before being
+    below between both but can could did does doing down during each few for
+    from further had has have having her here hers herself him himself his how
+    into its itself just let like more most myself nor not now off once only
+    other our ours ourselves out over own same she should some such than that
+    the their theirs them themselves then there these they this those through
+    too under until very was were what when where which while who whom why will
+    with would you your yours yourself yourselves
+    """.split()
+)
+
+
+class FullTextIndex:
+    """Full-text index of notes using SQLite FTS5.
+
+    Stopwords and ASCII words shorter than 3 characters are ignored. A note
+    is found only if it contains enough of the terms of the query, and
+    scores at least `min_relative_score` of the best BM25 score, so that
+    notes sharing only a word or two with a long query are not returned.
+
+    >>> index = FullTextIndex(":memory:")
+    >>> index.add("alice", [
+    ...     StoredNote("1", "Meeting with Bob on 2023-12-05", 0, 100, 10),
+    ...     StoredNote("2", "Alice likes green tea", 0, 100, 5),
+    ...     StoredNote("3", "Project code is HX-4242", 0, 10, 5),
+    ...     StoredNote("4", "The rain in Paris came with the wind", 0, 100, 10),
+    ... ])
+
+    >>> [x.id for x in index.query("alice", "when is the meeting with bob?", 10, 50)]
+    ['1']
+    >>> [x.id for x in index.query("alice", "The plan for the Paris office?", 10, 50)]
+    []
+    >>> [x.id for x in index.query("bob", "meeting", 10, 50)]
+    []
+    >>> [x.id for x in index.query("alice", "HX-4242", 10, 50)]
+    []
+    >>> [x.id for x in index.query("alice", "HX-4242", 10, 5)]
+    ['3']
+
+    >>> index.delete("alice", ["1"])
+    >>> index.optimize()
+    >>> [x.id for x in index.query("alice", "meeting", 10, 50)]
+    []
+    """
+
+    # Fraction of the terms of a query that a note must contain, up to
+    # `max_required_terms` terms.
+    min_coverage = 0.5
+    max_required_terms = 3
+
+    # Minimum ratio of the BM25 score of a note to the best one.
+    min_relative_score = 0.3
+
+    def __init__(self, path: str) -> None:
+        """Initialize the index.
+
+        :param path: Path to the database. `:memory:` for in-memory database.
+        """
+
+        self.__lock = threading.Lock()
+        self.__conn = sqlite3.connect(path, check_same_thread=False)
+
+        with self.__conn as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS settings (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL
+                )
+                """
+            )
+
+            for tokenizer in ["trigram", "unicode61 remove_diacritics 2"]:
+                try:
+                    conn.execute(
+                        f"""
+                        CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5 (
+                            id UNINDEXED,
+                            user_id UNINDEXED,
+                            content,
+                            created_at UNINDEXED,
+                            expires_at UNINDEXED,
+                            n_tokens UNINDEXED,
+                            tokenize = '{tokenizer}'
+                        )
+                        """
+                    )
+                    break
+                except sqlite3.OperationalError:
+                    continue
+
+            sql = conn.execute(
+                "SELECT sql FROM sqlite_master WHERE name = 'notes_fts'"
+            ).fetchone()[0]
+            self.trigram = "trigram" in sql
+
+    @property
+    def filled(self) -> bool:
+        """Whether `fill` has finished."""
+
+        with self.__lock:
+            row = self.__conn.execute(
+                "SELECT value FROM settings WHERE key = 'filled'"
+            ).fetchone()
+        return row is not None
+
+    def fill(self, notes: Iterable[tuple[str, list[StoredNote]]]) -> None:
+        """Replace the index with notes given as pairs of a user ID and notes.
+
+        The index is marked filled at the end, so that a fill interrupted by
+        a crash is redone at the next start.
+        """
+
+        with self.__lock, self.__conn as conn:
+            conn.execute("DELETE FROM settings WHERE key = 'filled'")
+            conn.execute("DELETE FROM notes_fts")
+
+        for user_id, stored in notes:
+            self.add(user_id, stored)
+
+        with self.__lock, self.__conn as conn:
+            conn.execute("REPLACE INTO settings (key, value) VALUES ('filled', '1')")
+
+    def terms(self, text: str) -> list[str]:
+        """Get the terms of `text` to search.
+
+        >>> FullTextIndex(":memory:").terms("Is it on 2023-12-05?")
+        ['2023-12-05']
+        >>> FullTextIndex(":memory:").terms("What is the plan with Bob?")
+        ['plan', 'Bob']
+        >>> FullTextIndex(":memory:").terms("東京の会議")
+        ['東京の', '京の会', 'の会議']
+        """
+
+        terms: list[str] = []
+        for word in re.findall(r"\w+(?:[-./:@]\w+)*", text):
+            if word.isascii():
+                if len(word) >= 3 and word.lower() not in STOPWORDS:
+                    terms.append(word)
+            elif self.trigram:
+                terms.extend(word[i : i + 3] for i in range(max(1, len(word) - 2)))
+            else:
+                terms.append(word)
+
+        return list(dict.fromkeys(terms))[:64]
+
+    def match_expression(self, terms: list[str]) -> str | None:
+        """Make a MATCH expression that matches any of `terms`.
+
+        >>> FullTextIndex(":memory:").match_expression(["plan", "Bob"])
+        '"plan" OR "Bob"'
+        """
+
+        if len(terms) == 0:
+            return None
+
+        return " OR ".join('"' + x.replace('"', '""') + '"' for x in terms)
+
+    def add(self, user_id: str, notes: list[StoredNote]) -> None:
+        with self.__lock, self.__conn as conn:
+            conn.executemany(
+                """
+                INSERT INTO notes_fts
+                    (id, user_id, content, created_at, expires_at, n_tokens)
+                VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                [
+                    (x.id, user_id, x.content, x.created_at, x.expires_at, x.n_tokens)
+                    for x in notes
+                ],
+            )
+
+    def delete(self, user_id: str, ids: list[str]) -> None:
+        with self.__lock, self.__conn as conn:
+            conn.execute(
+                f"""
+                DELETE FROM notes_fts
+                WHERE user_id = ? AND id IN ({", ".join("?" for _ in ids)})
+                """,
+                (user_id, *ids),
+            )
+
+    def optimize(self) -> None:
+        """Merge the index into a single b-tree, removing deleted entries."""
+
+        with self.__lock, self.__conn as conn:
+            conn.execute("INSERT INTO notes_fts (notes_fts) VALUES ('optimize')")
+
+    def query(
+        self, user_id: str, text: str, n_results: int, now: float
+    ) -> list[StoredNote]:
+        """Search notes not expired at `now`, ordered by BM25."""
+
+        terms = self.terms(text)
+        expression = self.match_expression(terms)
+        if expression is None:
+            return []
+
+        with self.__lock:
+            rows = self.__conn.execute(
+                """
+                SELECT id, content, created_at, expires_at, n_tokens, bm25(notes_fts)
+                FROM notes_fts
+                WHERE notes_fts MATCH ? AND user_id = ? AND expires_at > ?
+                ORDER BY bm25(notes_fts)
+                LIMIT ?
+                """,
+                (expression, user_id, now, n_results),
+            ).fetchall()
+
+        if len(rows) == 0:
+            return []
+
+        # BM25 scores of FTS5 are negative, and better ones are lower.
+        best = rows[0][5]
+        required = min(
+            self.max_required_terms, math.ceil(self.min_coverage * len(terms))
+        )
+        folded = [x.casefold() for x in terms]
+
+        return [
+            StoredNote(
+                id=row[0],
+                content=row[1],
+                created_at=row[2],
+                expires_at=row[3],
+                n_tokens=row[4],
+            )
+            for row in rows
+            if row[5] <= self.min_relative_score * best
+            and sum(x in row[1].casefold() for x in folded) >= required
+        ]
+
+    def close(self) -> None:
+        with self.__lock:
+            self.__conn.close()
+
+
+def reciprocal_rank_fusion(rankings: list[list[str]], k: int = 60) -> list[str]:
+    """Merge rankings of IDs by reciprocal rank fusion.
+
+    >>> reciprocal_rank_fusion([["a", "b", "c"], ["c", "d"]])
+    ['c', 'a', 'b', 'd']
+    """
+
+    scores: dict[str, float] = {}
+    for ranking in rankings:
+        for rank, id in enumerate(ranking):
+            scores[id] = scores.get(id, 0.0) + 1 / (k + rank + 1)
+
+    return sorted(scores, key=lambda x: scores[x], reverse=True)
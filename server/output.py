@@ -0,0 +1,172 @@
+import hashlib
+import os
+from collections import deque
+from typing import TextIO
+
+
+def output_path(directory: str, user_id: str, output_id: str) -> str:
+    """Get the path to the file of the whole output of an execution.
+
+    >>> output_path("outputs", "user1", "abc")
+    'outputs/0a041b9462caa4a3/abc.txt'
+    """
+
+    digest = hashlib.sha256(user_id.encode("utf-8")).hexdigest()
+    return os.path.join(directory, digest[:16], f"{output_id}.txt")
+
+
+def prune_outputs(directory: str, keep: int) -> None:
+    """Delete files of outputs in the directory except the newest `keep` ones."""
+
+    if not os.path.isdir(directory):
+        return
+
+    paths = sorted(
+        (os.path.join(directory, x) for x in os.listdir(directory)),
+        key=os.path.getmtime,
+        reverse=True,
+    )
+    for path in paths[keep:]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def _split(text: str, max_bytes: int) -> tuple[str, str]:
+    data = text.encode("utf-8", "replace")
+    if len(data) <= max_bytes:
+        return text, ""
+
+    head = data[:max_bytes].decode("utf-8", "ignore")
+    return head, text[len(head) :]
+
+
+class OutputBuffer:
+    """Text output of an execution, bounded in memory.
+
+    The first `max_bytes` bytes and the last `max_bytes` bytes are kept in
+    memory. Once the output exceeds `max_bytes`, the whole output is written
+    to the file at `path`, up to `max_file_bytes`.
+
+    >>> buffer = OutputBuffer(max_bytes=4)
+    >>> for i in range(6):
+    ...     buffer.write(f"{i}\\n")
+    >>> buffer.size, buffer.truncated
+    (12, True)
+    >>> print(buffer.getvalue())
+    0
+    1
+    ... 2 lines (4 bytes) omitted ...
+    4
+    5
+    <BLANKLINE>
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = 65536,
+        path: str | None = None,
+        max_file_bytes: int = 64 * 1024 * 1024,
+    ) -> None:
+        """Initialize the buffer.
+
+        :param max_bytes: Number of bytes to keep of each of the head and the
+            tail of the output.
+        :param path: Path to write the whole output to. None not to write.
+        :param max_file_bytes: Maximum number of bytes to write to the file.
+        """
+
+        self.max_bytes = max_bytes
+        self.path = path
+        self.max_file_bytes = max_file_bytes
+        self.size = 0
+
+        self.__head: list[str] = []
+        self.__head_size = 0
+        self.__tail: deque[tuple[str, int]] = deque()
+        self.__tail_size = 0
+        self.__omitted_size = 0
+        self.__omitted_lines = 0
+        self.__file: TextIO | None = None
+        self.__file_size = 0
+
+    @property
+    def truncated(self) -> bool:
+        """Whether the output exceeds `max_bytes`."""
+
+        return self.size > self.max_bytes
+
+    @property
+    def spilled(self) -> bool:
+        """Whether the output is written to the file."""
+
+        return self.__file is not None
+
+    def write(self, text: str) -> None:
+        """Append text to the output."""
+
+        self.size += len(text.encode("utf-8", "replace"))
+
+        if self.__head_size < self.max_bytes:
+            head, text = _split(text, self.max_bytes - self.__head_size)
+            self.__head.append(head)
+            self.__head_size += len(head.encode("utf-8", "replace"))
+
+        if text == "":
+            return
+
+        if self.path is not None and self.__file is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.__file = open(self.path, "w", encoding="utf-8", errors="replace")
+            self.__write_file("".join(self.__head))
+
+        self.__write_file(text)
+
+        self.__tail.append((text, len(text.encode("utf-8", "replace"))))
+        self.__tail_size += self.__tail[-1][1]
+
+        while self.__tail_size > self.max_bytes:
+            first, first_size = self.__tail.popleft()
+            excess = self.__tail_size - self.max_bytes
+
+            if first_size > excess:
+                dropped, rest = _split(first, excess)
+                if len(dropped.encode("utf-8", "replace")) < excess:
+                    # Drop the character across the boundary too.
+                    dropped, rest = first[: len(dropped) + 1], rest[1:]
+                rest_size = len(rest.encode("utf-8", "replace"))
+                self.__tail.appendleft((rest, rest_size))
+                first, first_size = dropped, first_size - rest_size
+
+            self.__tail_size -= first_size
+            self.__omitted_size += first_size
+            self.__omitted_lines += first.count("\n")
+
+    def __write_file(self, text: str) -> None:
+        if self.__file is None or self.__file_size >= self.max_file_bytes:
+            return
+
+        text, _ = _split(text, self.max_file_bytes - self.__file_size)
+        self.__file.write(text)
+        self.__file_size += len(text.encode("utf-8", "replace"))
+
+    def getvalue(self) -> str:
+        """Get the output, with the middle omitted if it's too long."""
+
+        head = "".join(self.__head)
+        tail = "".join(x for x, _ in self.__tail)
+
+        if self.__omitted_size == 0:
+            return head + tail
+
+        omitted = f"{self.__omitted_size} bytes"
+        if self.__omitted_lines > 0:
+            omitted = f"{self.__omitted_lines} lines ({omitted})"
+
+        separator = "" if head.endswith("\n") else "\n"
+        return f"{head}{separator}... {omitted} omitted ...\n{tail}"
+
+    def close(self) -> None:
+        if self.__file is not None:
+            self.__file.close()
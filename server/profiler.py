@@ -0,0 +1,91 @@
+import sys
+import threading
+import time
+from collections import Counter
+from types import FrameType
+
+
+def frame_name(frame: FrameType) -> str:
+    """Get a name of the frame for the collapsed stack format.
+
+    >>> frame_name(sys._getframe())
+    'profiler:<module>'
+    """
+
+    module = frame.f_globals.get("__name__", "?")
+    return f"{module}:{frame.f_code.co_qualname}"
+
+
+class Profiler:
+    """Sampling profiler for all threads of this process.
+
+    The result is in the collapsed stack format, which can be used by
+    flamegraph.pl or speedscope.
+
+    >>> def busy() -> None:
+    ...     deadline = time.monotonic() + 0.2
+    ...     while time.monotonic() < deadline:
+    ...         pass
+    >>> worker = threading.Thread(target=busy)
+    >>> worker.start()
+    >>> result = Profiler(interval=0.001).run(0.1)
+    >>> worker.join()
+    >>> any(line.split(" ")[0].endswith(":busy") for line in result.splitlines())
+    True
+    """
+
+    __lock = threading.Lock()
+
+    def __init__(self, interval: float = 0.005) -> None:
+        """Initialize the profiler.
+
+        :param interval: Interval of sampling in seconds.
+        """
+
+        self.interval = interval
+
+    def run(self, duration: float) -> str:
+        """Sample the stacks for `duration` seconds and return collapsed stacks.
+
+        :param duration: Duration of profiling in seconds.
+        :raises RuntimeError: If another profiling is running.
+        """
+
+        if not self.__lock.acquire(blocking=False):
+            raise RuntimeError("Another profiling is running")
+
+        try:
+            return self.__run(duration)
+        finally:
+            self.__lock.release()
+
+    def __run(self, duration: float) -> str:
+        me = threading.get_ident()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        stacks: Counter[str] = Counter()
+
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == me:
+                    continue
+
+                stack: list[str] = []
+                f: FrameType | None = frame
+                while f is not None:
+                    stack.append(frame_name(f))
+                    f = f.f_back
+
+                if thread_id not in names:
+                    names = {t.ident: t.name for t in threading.enumerate()}
+                stack.append(
+                    names.get(thread_id, str(thread_id))
+                    .replace(" ", "_")
+                    .replace(";", "_")
+                )
+
+                stacks[";".join(reversed(stack))] += 1
+
+            time.sleep(self.interval)
+
+        return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
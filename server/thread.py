@@ -3,16 +3,19 @@ import json
 import uuid
 from collections.abc import Awaitable, Callable
 from datetime import datetime, timedelta, timezone
-from typing import AsyncIterator, Self
+from typing import TYPE_CHECKING, AsyncIterator, Self
 from zoneinfo import ZoneInfo
 
-import openai
-
 import event
 from auth import User
-from coderunner import CodeRunner
+from chattokens import ChatTokenCounter, FunctionDefinition, get_model
 from history import HistoryDB
-from note import Note, NoteDB
+from note import AsyncNoteDB, Note
+from openaitypes import Message as OpenAIMessage
+from tokenizer import Tokenizer
+
+if TYPE_CHECKING:
+    from coderunner import CodeRunner, Kernel, KernelPool, RunnerOptions
 
 TERMS = {
     "a day": 1,
@@ -21,6 +24,107 @@ TERMS = {
     "forever": 1000 * 365,
 }
 
+MODEL = "gpt-3.5-turbo"
+
+# Tokens to leave for the reply in the context of the model.
+COMPLETION_TOKENS = 1024
+
+FUNCTIONS: list[FunctionDefinition] = [
+    {
+        "name": "save_notes",
+        "description": "Save notes to remember it later.",
+        "parameters": {
+            "type": "object",
+            "required": ["notes"],
+            "properties": {
+                "notes": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "required": ["content", "available_term"],
+                        "properties": {
+                            "content": {
+                                "desctiption": (
+                                    "The content to save. Follow 5W1H"
+                                    " method to write each note."
+                                ),
+                                "type": "string",
+                            },
+                            "available_term": {
+                                "description": (
+                                    "How long the information is meaningful"
+                                    " and useful."
+                                ),
+                                "type": "string",
+                                "enum": list(TERMS.keys()),
+                            },
+                        },
+                    },
+                    "minItems": 1,
+                },
+            },
+        },
+    },
+    {
+        "name": "search_notes",
+        "description": (
+            "Search notes that you saved. The result include IDs, created"
+            " timestamps, and note contents."
+        ),
+        "parameters": {
+            "type": "object",
+            "required": ["query"],
+            "properties": {
+                "query": {
+                    "type": "string",
+                },
+            },
+        },
+    },
+    {
+        "name": "delete_notes",
+        "description": "Delete notes that you saved.",
+        "parameters": {
+            "type": "object",
+            "required": ["ids"],
+            "properties": {
+                "ids": {
+                    "type": "array",
+                    "items": {
+                        "type": "string",
+                    },
+                    "minItems": 1,
+                },
+            },
+        },
+    },
+    {
+        "name": "run_code",
+        "description": (
+            "Run code in a Jupyter environment, and returns the output and"
+            " the result. To install packages, you can use `!pip install"
+            " <package>` for Python, and `apt-get install <package>` for"
+            " Bash."
+        ),
+        "parameters": {
+            "type": "object",
+            "required": ["language", "code"],
+            "properties": {
+                "language": {
+                    "type": "string",
+                    "enum": ["python", "bash"],
+                },
+                "code": {
+                    "type": "string",
+                },
+            },
+        },
+    },
+    # {
+    #    "name": "generate_image",
+    # },
+]
+
 EventHandler = Callable[[event.Event], Awaitable[None]]
 
 
@@ -33,12 +137,22 @@ class ThreadManager:
 
         return cls.__singleton
 
-    def __init__(self, history: HistoryDB, notes: NoteDB) -> None:
+    def __init__(
+        self,
+        history: HistoryDB,
+        notes: AsyncNoteDB,
+        kernels: "KernelPool | None" = None,
+        runner_options: "RunnerOptions | None" = None,
+        start_kernel: "Callable[[str], Awaitable[Kernel]] | None" = None,
+    ) -> None:
         super().__init__()
 
         self.threads: dict[str, Thread] = {}
         self.history = history
         self.notes = notes
+        self.kernels = kernels
+        self.runner_options = runner_options
+        self.start_kernel = start_kernel
 
     def get(self, user: User) -> "Thread":
         if user.id not in self.threads:
@@ -46,33 +160,46 @@ class ThreadManager:
                 user,
                 self.history,
                 self.notes,
+                kernels=self.kernels,
+                runner_options=self.runner_options,
+                start_kernel=self.start_kernel,
             )
         return self.threads[user.id]
 
     async def shutdown(self) -> None:
         await asyncio.gather(*[thread.shutdown() for thread in self.threads.values()])
+        self.notes.close()
 
 
 class Thread:
     user: User
     history: HistoryDB
-    notes: NoteDB
+    notes: AsyncNoteDB
     event_handlers: list[EventHandler]
     timezone: ZoneInfo
-    runners: dict[str, CodeRunner]
+    kernels: "KernelPool | None"
+    runner_options: "RunnerOptions | None"
+    start_kernel: "Callable[[str], Awaitable[Kernel]] | None"
+    runners: dict[str, "CodeRunner"]
 
     def __init__(
         self,
         user: User,
         history: HistoryDB,
-        notes: NoteDB,
+        notes: AsyncNoteDB,
         timezone: ZoneInfo = ZoneInfo("UTC"),
+        kernels: "KernelPool | None" = None,
+        runner_options: "RunnerOptions | None" = None,
+        start_kernel: "Callable[[str], Awaitable[Kernel]] | None" = None,
     ) -> None:
         self.user = user
         self.history = history
         self.notes = notes
         self.event_handlers = []
         self.timezone = timezone
+        self.kernels = kernels
+        self.runner_options = runner_options
+        self.start_kernel = start_kernel
         self.runners = {}
         with open("prompt.txt", "r") as f:
             self.prompt = f.read()
@@ -139,9 +266,24 @@ class Thread:
         assi_ev = event.Assistant(content="", source=source)
 
         last_user_msg = self.history.last_user_message(self.user.id)
+        related_notes = (
+            self.notes.query(self.user.id, last_user_msg)
+            if last_user_msg is not None
+            else None
+        )
+
+        # Load history while searching notes in the background. Messages that
+        # don't fit in the context are dropped anyway, so load about as many.
+        history = list(
+            self.history.load_by_tokens(
+                self.user.id, get_model(MODEL).context_length - COMPLETION_TOKENS
+            )
+        )
+        history.reverse()
+
         notes = []
-        if last_user_msg is not None:
-            notes = self.notes.query(self.user.id, last_user_msg)
+        if related_notes is not None:
+            notes = await related_notes
             n_tokens = 0
             for i, note in enumerate(notes):
                 n_tokens += note.n_tokens
@@ -171,112 +313,18 @@ class Thread:
             ]
         )
 
+        import openai
+
         completion = await openai.ChatCompletion.acreate(
-            model="gpt-3.5-turbo",
-            messages=[
+            model=MODEL,
+            messages=self.__fit_messages(
                 {
                     "role": "system",
                     "content": system_prompt,
                 },
-                *event.as_messages(
-                    [x.event for x in self.history.load(self.user.id, 2 * 1024)]
-                ),
-            ],
-            functions=[
-                {
-                    "name": "save_notes",
-                    "description": "Save notes to remember it later.",
-                    "parameters": {
-                        "type": "object",
-                        "required": ["notes"],
-                        "properties": {
-                            "notes": {
-                                "type": "array",
-                                "items": {
-                                    "type": "object",
-                                    "required": ["content", "available_term"],
-                                    "properties": {
-                                        "content": {
-                                            "desctiption": (
-                                                "The content to save. Follow 5W1H"
-                                                " method to write each note."
-                                            ),
-                                            "type": "string",
-                                        },
-                                        "available_term": {
-                                            "description": (
-                                                "How long the information is meaningful"
-                                                " and useful."
-                                            ),
-                                            "type": "string",
-                                            "enum": list(TERMS.keys()),
-                                        },
-                                    },
-                                },
-                                "minItems": 1,
-                            },
-                        },
-                    },
-                },
-                {
-                    "name": "search_notes",
-                    "description": (
-                        "Search notes that you saved. The result include IDs, created"
-                        " timestamps, and note contents."
-                    ),
-                    "parameters": {
-                        "type": "object",
-                        "required": ["query"],
-                        "properties": {
-                            "query": {
-                                "type": "string",
-                            },
-                        },
-                    },
-                },
-                {
-                    "name": "delete_notes",
-                    "description": "Delete notes that you saved.",
-                    "parameters": {
-                        "type": "object",
-                        "required": ["ids"],
-                        "properties": {
-                            "ids": {
-                                "type": "array",
-                                "items": {
-                                    "type": "string",
-                                },
-                                "minItems": 1,
-                            },
-                        },
-                    },
-                },
-                {
-                    "name": "run_code",
-                    "description": (
-                        "Run code in a Jupyter environment, and returns the output and"
-                        " the result. To install packages, you can use `!pip install"
-                        " <package>` for Python, and `apt-get install <package>` for"
-                        " Bash."
-                    ),
-                    "parameters": {
-                        "type": "object",
-                        "required": ["language", "code"],
-                        "properties": {
-                            "language": {
-                                "type": "string",
-                                "enum": ["python", "bash"],
-                            },
-                            "code": {
-                                "type": "string",
-                            },
-                        },
-                    },
-                },
-                # {
-                #    "name": "generate_image",
-                # },
-            ],
+                list(event.as_messages(history)),
+            ),
+            functions=FUNCTIONS,
             user="hexe/" + self.user.id,
             stream=True,
         )
@@ -344,6 +392,34 @@ class Thread:
                     await self.__event(result)
                     await self.__invoke(result.id)
 
+    def __fit_messages(
+        self, system: OpenAIMessage, messages: list[OpenAIMessage]
+    ) -> list[OpenAIMessage]:
+        """Take the latest messages that fit in the context of the model.
+
+        The system message, the functions and `COMPLETION_TOKENS` for the
+        reply are reserved first. The last message is always taken.
+        """
+
+        counter = ChatTokenCounter(MODEL)
+        budget = (
+            counter.model.context_length
+            - COMPLETION_TOKENS
+            - counter.request([system], FUNCTIONS)
+        )
+
+        n_tokens = 0
+        start = len(messages)
+        while start > 0:
+            n = counter.message(messages[start - 1])
+            if n_tokens + n > budget and start < len(messages):
+                break
+
+            n_tokens += n
+            start -= 1
+
+        return [system, *messages[start:]]
+
     async def call_function(self, source: event.FunctionCall) -> event.Event:
         """Call a function and put the result to the history."""
 
@@ -416,15 +492,21 @@ class Thread:
             )
 
         now = datetime.now(timezone.utc)
+        args_notes = [
+            note for note in args["notes"] if len(note["content"].strip()) > 0
+        ]
         notes = [
             Note(
                 content=note["content"].strip(),
                 created_at=now,
                 expires_at=now
                 + timedelta(days=TERMS[note.get("available_term", "forever")]),
+                n_tokens=n_tokens,
+            )
+            for note, n_tokens in zip(
+                args_notes,
+                Tokenizer().count_many([x["content"].strip() for x in args_notes]),
             )
-            for note in args["notes"]
-            if len(note["content"].strip()) > 0
         ]
 
         if len(notes) == 0:
@@ -436,7 +518,7 @@ class Thread:
             )
 
         try:
-            self.notes.save(self.user.id, notes)
+            await self.notes.save(self.user.id, notes)
         except Exception as err:
             return event.Error(
                 content=f"save_notes: Failed to save notes.\n> {err}",
@@ -473,7 +555,7 @@ class Thread:
             )
 
         try:
-            all_result = self.notes.query(
+            all_result = await self.notes.query(
                 self.user.id, query, n_results=100, threshold=0.2
             )
         except Exception as err:
@@ -500,6 +582,8 @@ class Thread:
                 source=source.id,
             )
 
+        # Token counts of notes are stored with them, so no need to estimate.
+        limited_result = all_result
         n_tokens = 0
         for i, note in enumerate(all_result):
             n_tokens += note.n_tokens
@@ -563,7 +647,7 @@ class Thread:
             )
 
         try:
-            self.notes.delete(self.user.id, ids)
+            await self.notes.delete(self.user.id, ids)
         except Exception as err:
             return event.Error(
                 content=f"delete_notes: Failed to delete notes.\n> {err}",
@@ -603,7 +687,15 @@ class Thread:
         code = args["code"].strip()
 
         if language not in self.runners:
-            self.runners[language] = CodeRunner(self.user.id, language)
+            from coderunner import CodeRunner
+
+            self.runners[language] = CodeRunner(
+                self.user.id,
+                language,
+                pool=self.kernels,
+                options=self.runner_options,
+                start=self.start_kernel,
+            )
 
         runner = self.runners[language]
 
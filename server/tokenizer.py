@@ -1,28 +1,228 @@
-from typing import Self
+import hashlib
+import math
+import threading
+from collections import OrderedDict
+from collections.abc import Callable
+from typing import TYPE_CHECKING, Self
 
-import tiktoken
+if TYPE_CHECKING:
+    import tiktoken
 
 
 class Tokenizer:
-    """LLM tokenizer."""
+    """LLM tokenizer.
+
+    Counts of tokens are memoized by hash of texts, so counting the same
+    text again doesn't encode it.
+    """
 
     __singleton: Self | None = None
 
-    __tokenizer: tiktoken.Encoding
+    __tokenizer: "tiktoken.Encoding"
+    __lock: threading.Lock
+    __counts: OrderedDict[bytes, int]
+    __hits: int
+    __misses: int
+
+    # Maximum number of texts to memoize counts of.
+    max_cache_entries = 65536
 
     def __new__(cls, *args, **kwargs) -> "Tokenizer":
         if cls.__singleton is None:
-            cls.__singleton = super().__new__(cls)
-            cls.__singleton.__tokenizer = tiktoken.get_encoding("cl100k_base")
+            import tiktoken
+
+            tokenizer = super().__new__(cls)
+            tokenizer.__tokenizer = tiktoken.get_encoding("cl100k_base")
+            tokenizer.__lock = threading.Lock()
+            tokenizer.__counts = OrderedDict()
+            tokenizer.__hits = 0
+            tokenizer.__misses = 0
+            cls.__singleton = tokenizer
 
         return cls.__singleton
 
+    @classmethod
+    def loaded(cls) -> bool:
+        """Whether the encoding is loaded, which may take file or network I/O."""
+
+        return cls.__singleton is not None
+
     def encode(self, text: str) -> list[int]:
         """Encode text to tokens."""
 
         return self.__tokenizer.encode(text)
 
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """Omit the middle of the text to fit it in about `max_tokens` tokens.
+
+        The head and the tail are kept, since outputs of programs tend to
+        have headers at the head and results or errors at the tail.
+        """
+
+        if self.count(text) <= max_tokens:
+            return text
+
+        tokens = self.__tokenizer.encode_ordinary(text)
+        head = max_tokens // 2
+        tail = max_tokens - head
+        return (
+            f"{self.__tokenizer.decode(tokens[:head])}"
+            f"\n... {len(tokens) - head - tail} tokens omitted ...\n"
+            f"{self.__tokenizer.decode(tokens[len(tokens) - tail:])}"
+        )
+
+    @staticmethod
+    def __key(text: str) -> bytes:
+        return hashlib.blake2b(
+            text.encode("utf-8", "surrogatepass"), digest_size=16
+        ).digest()
+
     def count(self, text: str) -> int:
         """Count number of tokens."""
 
-        return len(self.encode(text))
+        return self.count_many([text])[0]
+
+    def count_many(self, texts: list[str]) -> list[int]:
+        """Count number of tokens of each text.
+
+        Texts that are not memoized are encoded at once in multiple threads.
+        """
+
+        keys = [self.__key(text) for text in texts]
+        counts: list[int | None] = []
+
+        with self.__lock:
+            for key in keys:
+                count = self.__counts.get(key)
+                if count is not None:
+                    self.__counts.move_to_end(key)
+                counts.append(count)
+
+        missing = {
+            key: text for key, text, count in zip(keys, texts, counts) if count is None
+        }
+        encoded: dict[bytes, int] = {}
+        if len(missing) == 1:
+            key, text = next(iter(missing.items()))
+            encoded[key] = len(self.__tokenizer.encode_ordinary(text))
+        elif len(missing) > 1:
+            tokens = self.__tokenizer.encode_ordinary_batch(list(missing.values()))
+            encoded = {key: len(x) for key, x in zip(missing.keys(), tokens)}
+
+        with self.__lock:
+            self.__hits += len(texts) - len(missing)
+            self.__misses += len(missing)
+
+            self.__counts.update(encoded)
+            while len(self.__counts) > self.max_cache_entries:
+                self.__counts.popitem(last=False)
+
+        return [
+            count if count is not None else encoded[key]
+            for key, count in zip(keys, counts)
+        ]
+
+    def stats(self) -> dict[str, int | float]:
+        """Get statistics of the memoized counts."""
+
+        with self.__lock:
+            total = self.__hits + self.__misses
+            return {
+                "hits": self.__hits,
+                "misses": self.__misses,
+                "hit_rate": self.__hits / total if total > 0 else 0.0,
+                "entries": len(self.__counts),
+            }
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimate number of tokens without encoding.
+
+    The estimate is 1 token per 3 ASCII characters and 1 token per 2 bytes
+    of other characters in UTF-8, which is more than the exact count of
+    cl100k_base for most English, code and CJK texts.
+
+    >>> estimate_tokens("Hello, world!")
+    5
+    >>> estimate_tokens("こんにちは")
+    8
+    """
+
+    n_ascii = len(text.encode("ascii", "ignore"))
+    n_other_bytes = len(text.encode("utf-8", "surrogatepass")) - n_ascii
+
+    return math.ceil(n_ascii / 3 + n_other_bytes / 2)
+
+
+class TokenBudget:
+    """Running total of tokens against a limit.
+
+    Tokens are estimated while the total is far from the limit, and counted
+    exactly once the estimated total gets within `error` of the limit.
+
+    >>> budget = TokenBudget(10, count_many=lambda xs: [len(x) // 4 for x in xs])
+    >>> budget.add("x" * 20)
+    True
+    >>> budget.exact, budget.total
+    (False, 7)
+    >>> budget.add("x" * 8)
+    True
+    >>> budget.exact, budget.total
+    (True, 7)
+    >>> budget.add("x" * 16)
+    False
+    """
+
+    def __init__(
+        self,
+        limit: int,
+        error: float = 0.25,
+        count_many: Callable[[list[str]], list[int]] | None = None,
+    ) -> None:
+        """Initialize the budget.
+
+        :param limit: Maximum number of tokens.
+        :param error: Relative error of estimates to tolerate.
+        :param count_many: Function to count tokens exactly.
+            `Tokenizer.count_many` by default.
+        """
+
+        self.limit = limit
+        self.error = error
+        self.exact = False
+
+        self.__count_many = count_many
+        self.__texts: list[str] = []
+        self.__total = 0
+
+    @property
+    def total(self) -> int:
+        """Total tokens of added texts. Estimated unless `exact`."""
+
+        return self.__total
+
+    def __count(self, texts: list[str]) -> list[int]:
+        if self.__count_many is None:
+            return Tokenizer().count_many(texts)
+        return self.__count_many(texts)
+
+    def add(self, text: str) -> bool:
+        """Add the text if it fits in the limit, and return whether it's added."""
+
+        if not self.exact:
+            estimated = self.__total + estimate_tokens(text)
+            if estimated * (1 + self.error) <= self.limit:
+                self.__total = estimated
+                self.__texts.append(text)
+                return True
+
+            self.__total = sum(self.__count(self.__texts))
+            self.__texts.clear()
+            self.exact = True
+
+        n_tokens = self.__count([text])[0]
+        if self.__total + n_tokens > self.limit:
+            return False
+
+        self.__total += n_tokens
+        return True
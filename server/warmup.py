@@ -0,0 +1,163 @@
+import asyncio
+import importlib
+import logging
+import time
+from collections.abc import Awaitable, Callable
+
+logger = logging.getLogger(__name__)
+
+
+def import_modules(names: list[str]) -> dict[str, float]:
+    """Import modules, and return seconds taken to import each of them.
+
+    Modules imported already, including ones imported by a preceding module,
+    take no time.
+
+    >>> durations = import_modules(["json", "json"])
+    >>> list(durations), durations["json"] < 1
+    (['json'], True)
+    """
+
+    durations: dict[str, float] = {}
+    for name in names:
+        start = time.perf_counter()
+        importlib.import_module(name)
+        durations[name] = time.perf_counter() - start
+        logger.info("Imported %s in %.3fs", name, durations[name])
+
+    return durations
+
+
+class Warmup:
+    """Steps to run before the server gets ready.
+
+    Steps run in the order they are added. A failed step is retried after
+    `retry_interval` seconds, doubled at each failure up to
+    `max_retry_interval`, and later steps wait for it. An optional step is
+    given up after `max_attempts` attempts, so that it doesn't keep the
+    server from getting ready.
+
+    >>> failures = [ValueError("offline")]
+    >>> async def flaky() -> None:
+    ...     if failures:
+    ...         raise failures.pop()
+    >>> async def broken() -> None:
+    ...     raise ValueError("offline")
+    >>> async def ok() -> None:
+    ...     pass
+    >>> warmup = Warmup(retry_interval=0, max_attempts=2)
+    >>> warmup.add("flaky", flaky)
+    >>> warmup.add("broken", broken, required=False)
+    >>> warmup.add("ok", ok)
+    >>> warmup.status()
+    {'ready': False, 'pending': ['flaky', 'broken', 'ok'], 'error': None}
+    >>> asyncio.run(warmup.run())
+    >>> warmup.ready, list(warmup.status()["steps"]), warmup.status()["failed"]
+    (True, ['flaky', 'ok'], {'broken': 'offline'})
+    """
+
+    def __init__(
+        self,
+        retry_interval: float = 1,
+        max_retry_interval: float = 60,
+        max_attempts: int = 3,
+    ) -> None:
+        """Initialize the warmup.
+
+        :param retry_interval: Seconds to wait before retrying a failed step
+            at the first time.
+        :param max_retry_interval: Maximum seconds to wait before retrying.
+        :param max_attempts: Number of attempts of an optional step.
+        """
+
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.max_attempts = max_attempts
+        self.ready = False
+
+        self.__steps: list[tuple[str, Callable[[], Awaitable[None]], bool]] = []
+        self.__durations: dict[str, float] = {}
+        self.__failed: dict[str, str] = {}
+        self.__error: str | None = None
+
+    def add(
+        self, name: str, step: Callable[[], Awaitable[None]], required: bool = True
+    ) -> None:
+        """Add a step to run.
+
+        :param required: Whether the server needs the step to get ready.
+            Otherwise the step only makes later requests faster.
+        """
+
+        self.__steps.append((name, step, required))
+
+    async def run(self) -> None:
+        """Run steps until required ones succeed, and mark the server ready."""
+
+        start = time.perf_counter()
+
+        for name, step, required in self.__steps:
+            await self.__run_step(name, step, required)
+
+        self.__error = None
+        self.ready = True
+        logger.info("Server is ready in %.3fs", time.perf_counter() - start)
+
+    async def __run_step(
+        self, name: str, step: Callable[[], Awaitable[None]], required: bool
+    ) -> None:
+        interval = self.retry_interval
+        attempts = 0
+
+        while True:
+            step_start = time.perf_counter()
+            try:
+                await step()
+            except Exception as err:
+                attempts += 1
+                self.__error = f"{name}: {err}"
+
+                if not required and attempts >= self.max_attempts:
+                    self.__failed[name] = str(err)
+                    logger.warning(
+                        "Gave up warming up %s after %d attempts: %s",
+                        name,
+                        attempts,
+                        err,
+                    )
+                    return
+
+                # The traceback is logged only once, since retries of a step
+                # usually fail in the same way.
+                if attempts == 1:
+                    logger.exception("Failed to warm up %s", name)
+                else:
+                    logger.warning("Failed to warm up %s again: %s", name, err)
+
+                await asyncio.sleep(interval)
+                interval = min(2 * interval, self.max_retry_interval)
+                continue
+
+            self.__durations[name] = time.perf_counter() - step_start
+            self.__error = None
+            logger.info("Warmed up %s in %.3fs", name, self.__durations[name])
+            return
+
+    def status(self) -> dict:
+        """Get the readiness, seconds taken by finished steps, and pending steps.
+
+        Optional steps given up are reported in `failed` with their errors.
+        """
+
+        if self.ready:
+            return {"ready": True, "steps": self.__durations, "failed": self.__failed}
+
+        return {
+            "ready": False,
+            "pending": [
+                x
+                for x, _, _ in self.__steps
+                if x not in self.__durations and x not in self.__failed
+            ],
+            "error": self.__error,
+        }